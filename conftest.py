@@ -0,0 +1 @@
+# makes the `src` package importable by the tests, also when running `pytest`
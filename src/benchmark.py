@@ -0,0 +1,268 @@
+import json
+import math
+import os
+from pathlib import Path
+import random
+import resource
+import subprocess
+import sys
+from time import time
+from typing import List, Optional
+
+from loguru import logger
+import psycopg2
+import typer
+from typer import Option
+
+from src.ingest import Backend, open_backend
+from src.ingest_helper import insertion_chunks
+from src.ingest_metrics import metrics
+
+app = typer.Typer()
+
+WORDS = (
+    "the a of to and in is it that for you was with on as have but be they "
+    "reddit post comment thread edit upvote subreddit thanks source link "
+    "postgres python data chunk copy insert index table query"
+).split()
+
+
+class HelpMessages:
+    data_dir = "Directory of the synthetic data, in the layout of the downloader"
+    subreddits = "How many subreddits to generate"
+    submissions = "Submissions of each subreddit"
+    comments = "Comments of each submission"
+    laps = "Files the records of a subreddit are split in"
+    duplicates = "Fraction of the records of each lap downloaded again in the next"
+    seed = "Seed of the random generator, the same seed gives the same data"
+    backends = "The backends to measure, by default all of them"
+    connection_string = "The Postgres connection string, the tables are dropped!"
+    chunk_size = "Records written in the DB at a time"
+    parallelism = "Connections writing each chunk at the same time"
+    output = "JSON lines file to append the results to, by default stdout"
+
+
+def to_base36(number: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    encoded = ""
+    while True:
+        number, digit = divmod(number, 36)
+        encoded = digits[digit] + encoded
+        if number == 0:
+            return encoded
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choices(WORDS, k=words))
+
+
+def generate_lap(rng, sub_name: str, ids, submissions: int, comments: int, lap: int):
+    """The submissions and comments of a lap, with new ids"""
+    subs, coms = [], []
+    retrieved_at = 1609459200 + lap * 3600
+    for _ in range(submissions):
+        sub_id = to_base36(next(ids))
+        created_utc = retrieved_at - rng.randrange(86400)
+        sub = dict(
+            author=f"user{rng.randrange(1000)}",
+            id=sub_id,
+            created_utc=created_utc,
+            title=random_text(rng, rng.randint(3, 15)),
+            permalink=f"/r/{sub_name}/comments/{sub_id}/synthetic/",
+            score=rng.randrange(1000),
+            retrieved_at=retrieved_at,
+            locked=False,
+        )
+        if rng.random() < 0.5:
+            sub["selftext"] = random_text(rng, rng.randint(0, 200))
+        else:
+            sub["link"] = f"https://example.com/{sub_id}"
+        subs.append(sub)
+        for _ in range(comments):
+            com_id = to_base36(next(ids))
+            coms.append(
+                dict(
+                    id=com_id,
+                    body=random_text(rng, rng.randint(1, 100)),
+                    created_utc=created_utc + rng.randrange(3600),
+                    parent_id=f"t3_{sub_id}",
+                    permalink=f"/r/{sub_name}/comments/{sub_id}/synthetic/{com_id}/",
+                    score=rng.randrange(100),
+                    retrieved_at=retrieved_at,
+                    author=f"user{rng.randrange(1000)}",
+                )
+            )
+    return subs, coms
+
+
+def redownloaded(rng, records: list[dict], fraction: float, lap: int) -> list[dict]:
+    """A fraction of the records, downloaded again with an updated score"""
+    again = []
+    for record in rng.sample(records, int(len(records) * fraction)):
+        record = dict(record, retrieved_at=1609459200 + lap * 3600)
+        record["score"] += rng.randrange(10)
+        again.append(record)
+    return again
+
+
+def write_jsonl(path: Path, records: list[dict]):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record))
+            f.write("\n")
+
+
+@app.command()
+def generate(
+    data_dir: str = Option("benchmark_data", help=HelpMessages.data_dir),
+    subreddits: int = Option(2, help=HelpMessages.subreddits),
+    submissions: int = Option(1000, help=HelpMessages.submissions),
+    comments: int = Option(20, help=HelpMessages.comments),
+    laps: int = Option(10, help=HelpMessages.laps),
+    duplicates: float = Option(0.1, help=HelpMessages.duplicates),
+    seed: int = Option(0, help=HelpMessages.seed),
+):
+    """
+    Generate a synthetic dataset, to benchmark the ingest on the same data.
+    """
+    assert not (
+        os.path.isdir(data_dir) and os.listdir(data_dir)
+    ), f"The data directory `{data_dir}` is not empty"
+    rng = random.Random(seed)
+    ids = iter(range(36 ** 5, sys.maxsize))
+    for sub_index in range(subreddits):
+        sub_name = f"synthetic{sub_index}"
+        run_dir = Path(data_dir) / sub_name / "benchmark"
+        (run_dir / "submissions").mkdir(parents=True)
+        (run_dir / "comments").mkdir(parents=True)
+        subs, coms = [], []
+        for lap in range(laps):
+            previous_subs, previous_coms = subs, coms
+            subs, coms = generate_lap(
+                rng, sub_name, ids, submissions // laps, comments, lap
+            )
+            subs += redownloaded(rng, previous_subs, duplicates, lap)
+            coms += redownloaded(rng, previous_coms, duplicates, lap)
+            write_jsonl(run_dir / "submissions" / f"{lap}.jsonl", subs)
+            write_jsonl(run_dir / "comments" / f"{lap}.jsonl", coms)
+        logger.info(f"Generated r/{sub_name} in {run_dir}")
+
+
+def wal_position(conn) -> int:
+    """Bytes written in the WAL by the whole server so far"""
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')")
+        return int(cur.fetchone()[0])
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Nearest-rank percentile, defined also for a single value"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+@app.command(hidden=True)
+def measure(
+    backend: Backend = Option(...),
+    connection_string: str = Option(...),
+    data_dir: str = Option(...),
+    chunk_size: int = Option(...),
+    parallelism: int = Option(...),
+):
+    """
+    Ingest the data from empty tables with a backend, printing the result.
+    Run in its own process by `run`, for the peak memory to be its own
+    """
+    admin = psycopg2.connect(connection_string)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS submission, comment")
+    db = open_backend(backend, connection_string, parallelism)
+    db.create_tables()
+    wal_start = wal_position(admin)
+    chunk_times, rows = [], 0
+    start_time = time()
+    for subs, coms in insertion_chunks(chunk_size, data_dir):
+        chunk_start = time()
+        db.upsert(subs, coms)
+        db.commit()
+        chunk_times.append(time() - chunk_start)
+        rows += len(subs) + len(coms)
+    seconds = time() - start_time
+    db.close()
+    wal_bytes = wal_position(admin) - wal_start
+    admin.close()
+    # kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_parser_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result = dict(
+        backend=backend.value,
+        parallelism=parallelism,
+        chunk_size=chunk_size,
+        chunks=len(chunk_times),
+        rows=rows,
+        seconds=round(seconds, 3),
+        rows_per_second=round(rows / seconds),
+        chunk_p50_seconds=round(percentile(chunk_times, 50), 4),
+        chunk_p99_seconds=round(percentile(chunk_times, 99), 4),
+        peak_rss_mb=round(peak_rss / 1024, 1),
+        peak_parser_rss_mb=round(peak_parser_rss / 1024, 1),
+        wal_mb=round(wal_bytes / 1024 / 1024, 2),
+        stage_seconds={
+            stage: round(seconds, 3)
+            for stage, seconds in sorted(metrics.stage_seconds().items())
+        },
+    )
+    print(json.dumps(result))
+
+
+@app.command()
+def run(
+    backends: Optional[List[Backend]] = Option(None, help=HelpMessages.backends),
+    connection_string: str = Option(
+        ...,
+        envvar="BENCHMARK_CONNECTION_STRING",
+        help=HelpMessages.connection_string,
+    ),
+    data_dir: str = Option("benchmark_data", help=HelpMessages.data_dir),
+    chunk_size: int = Option(50000, help=HelpMessages.chunk_size),
+    parallelism: int = Option(1, help=HelpMessages.parallelism),
+    output: Optional[str] = Option(None, help=HelpMessages.output),
+):
+    """
+    Ingest the data with every backend from empty tables, measuring rows/s,
+    chunk latency, peak memory and WAL volume. The results are JSON lines.
+
+    Use a dedicated database, the WAL volume is of the whole server.
+    """
+    for backend in backends or list(Backend):
+        logger.info(f"Measuring {backend.value}...")
+        measured = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "src.benchmark",
+                "measure",
+                f"--backend={backend.value}",
+                f"--connection-string={connection_string}",
+                f"--data-dir={data_dir}",
+                f"--chunk-size={chunk_size}",
+                f"--parallelism={parallelism}",
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if measured.returncode != 0:
+            # e.g. the driver of the backend is not installed
+            logger.error(f"The {backend.value} backend failed, see the log above")
+            continue
+        result = measured.stdout.strip().splitlines()[-1]
+        if output is None:
+            print(result)
+        else:
+            with open(output, "a") as f:
+                f.write(result + "\n")
+
+
+if __name__ == "__main__":
+    app()
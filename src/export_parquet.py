@@ -0,0 +1,145 @@
+from dataclasses import fields
+from datetime import datetime, timezone
+import os
+from os.path import join
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import typer
+from typer import Option
+from loguru import logger
+
+from src.ingest_helper import Submission, Comment, insertion_chunks
+
+# the timestamps are stored as epoch seconds in the JSONL files
+TIMESTAMP_COLUMNS = {"created_utc", "retrieved_at"}
+ARROW_TYPES = {
+    str: pa.string(),
+    int: pa.int64(),
+    bool: pa.bool_(),
+}
+
+
+def arrow_schema(record_type) -> pa.Schema:
+    """Schema with a column for every field of the dataclass, plus the month"""
+    columns = []
+    for f in fields(record_type):
+        if f.name in TIMESTAMP_COLUMNS:
+            columns.append(pa.field(f.name, pa.timestamp("s", tz="UTC")))
+        else:
+            columns.append(pa.field(f.name, ARROW_TYPES[f.type]))
+    columns.append(pa.field("month", pa.string()))
+    return pa.schema(columns)
+
+
+SUBMISSION_SCHEMA = arrow_schema(Submission)
+COMMENT_SCHEMA = arrow_schema(Comment)
+
+
+def to_table(records, schema: pa.Schema) -> pa.Table:
+    columns = {name: [] for name in schema.names}
+    for r in records:
+        for name in schema.names[:-1]:
+            columns[name].append(getattr(r, name))
+        columns["month"].append(
+            datetime.fromtimestamp(r.created_utc, tz=timezone.utc).strftime("%Y-%m")
+        )
+    return pa.Table.from_pydict(columns, schema=schema)
+
+
+def write_chunk(table: pa.Table, output_dir: str, chunk_id: int):
+    ds.write_dataset(
+        table,
+        output_dir,
+        format="parquet",
+        partitioning=["subreddit", "month"],
+        partitioning_flavor="hive",
+        basename_template=f"part-{chunk_id}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def latest_rows(table: pa.Table) -> pa.Table:
+    """The row with the latest `retrieved_at` of every id"""
+    if table.num_rows < 2:
+        return table
+    table = table.take(
+        pc.sort_indices(
+            table, sort_keys=[("id", "ascending"), ("retrieved_at", "descending")]
+        )
+    )
+    ids = table["id"].combine_chunks()
+    # the first row of every id
+    first = pa.concat_arrays([pa.array([True]), pc.not_equal(ids[1:], ids[:-1])])
+    return table.filter(first)
+
+
+def merge_partition(partition_dir: str, paths: list[str]) -> int:
+    """
+    Merge the files of a partition in one, without the duplicates the chunks
+    wrote in different files. Return how many rows were dropped.
+    """
+    table = pa.concat_tables(pq.ParquetFile(path).read() for path in paths)
+    merged = latest_rows(table)
+    tmp_path = join(partition_dir, "merged.tmp")
+    pq.write_table(merged, tmp_path)
+    # replacing one of the files first, a crash leaves duplicates, not a loss
+    os.replace(tmp_path, paths[0])
+    for path in paths[1:]:
+        os.remove(path)
+    return table.num_rows - merged.num_rows
+
+
+def merge_partitions(dataset_dir: str) -> int:
+    dropped = 0
+    for root, _dirs, files in os.walk(dataset_dir):
+        paths = sorted(join(root, f) for f in files if f.endswith(".parquet"))
+        if len(paths) > 1:
+            dropped += merge_partition(root, paths)
+    return dropped
+
+
+def main(
+    data_dir: str = Option("data", help="Directory with the downloaded JSONL files"),
+    output_dir: str = Option("parquet", help="Directory to write the Parquet files"),
+    chunk_size: int = Option(50000, help="Records to convert at a time"),
+):
+    """
+    Convert the downloaded data to Parquet, partitioned by subreddit and month.
+
+    Submissions and comments go in two datasets, `submission` and `comment`,
+    with a column for each field of `Submission` and `Comment`.
+    An id downloaded more than once is exported once, with the latest
+    `retrieved_at`: the chunks are written first, then the files of each
+    partition are merged, a record and its duplicates are in the same one.
+    """
+    assert not (
+        os.path.isdir(output_dir) and os.listdir(output_dir)
+    ), f"The output directory `{output_dir}` is not empty"
+    total_subs, total_coms = 0, 0
+    for chunk_id, (subs, coms) in enumerate(insertion_chunks(chunk_size, data_dir)):
+        total_subs += len(subs)
+        total_coms += len(coms)
+        if subs:
+            write_chunk(
+                to_table(subs.values(), SUBMISSION_SCHEMA),
+                join(output_dir, "submission"),
+                chunk_id,
+            )
+        logger.info(f"Submissions exported so far: {total_subs}")
+        if coms:
+            write_chunk(
+                to_table(coms.values(), COMMENT_SCHEMA),
+                join(output_dir, "comment"),
+                chunk_id,
+            )
+        logger.info(f"Comments exported so far: {total_coms}")
+    for dataset in ("submission", "comment"):
+        dropped = merge_partitions(join(output_dir, dataset))
+        logger.info(f"Dropped {dropped} {dataset} duplicates of the other chunks")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,240 @@
+from enum import Enum
+from functools import partial
+import importlib
+from typing import Optional
+
+from loguru import logger
+import typer
+from typer import Option
+
+from src.ingest_backend import IngestBackend, LookupKeys, ParallelBackend, drop_stale
+from src.ingest_helper import (
+    CONNECTION_STRING,
+    MANIFEST_PATH,
+    ChunkLimits,
+    IngestManifest,
+    insertion_chunks,
+)
+from src.ingest_metrics import metrics
+from src.ingest_schema import finish_bulk_load_statement
+
+
+class Backend(str, Enum):
+    psycopg2 = "psycopg2"
+    psycopg3 = "psycopg3"
+    psycopg3_copy = "psycopg3-copy"
+    asyncpg = "asyncpg"
+    asyncpg_copy = "asyncpg-copy"
+
+
+# module and class of each backend, imported only when used so that only
+# the driver of the chosen one has to be installed
+BACKENDS = {
+    Backend.psycopg2: ("src.ingest_into_postgres_psycopg2", "Psycopg2Backend"),
+    Backend.psycopg3: ("src.ingest_into_postgres_psycopg3", "Psycopg3Backend"),
+    Backend.psycopg3_copy: (
+        "src.ingest_into_postgres_psycopg3_with_copy",
+        "Psycopg3CopyBackend",
+    ),
+    Backend.asyncpg: ("src.ingest_into_postgres_asyncpg", "AsyncpgBackend"),
+    Backend.asyncpg_copy: ("src.ingest_into_postgres_asyncpg", "AsyncpgCopyBackend"),
+}
+# the backends of --bulk-load and --compact
+COPY_BACKENDS = [Backend.psycopg3_copy, Backend.asyncpg_copy]
+
+
+class HelpMessages:
+    backend = "How to write the data in the DB"
+    connection_string = "The Postgres connection string"
+    data_dir = "Directory with the downloaded JSONL files"
+    chunk_size = "Records written in the DB at a time"
+    chunk_mb = "Maximum size of the submissions, and of the comments, in a chunk"
+    processes = "Processes parsing the files, by default one per CPU"
+    prefetch = "Chunks prepared while the current one is written"
+    parallelism = "Connections writing each chunk at the same time"
+    chunks_in_flight = (
+        "Chunks written at the same time, a connection moves to the next chunk "
+        "without waiting for the others. At most --commit-every"
+    )
+    commit_every = "Chunks written in a transaction"
+    incremental = "Skip the files already ingested, listed in the manifest"
+    manifest = "The manifest of the files already ingested"
+    partitioned = "Partition the comments by year of creation, when creating the tables"
+    bulk_load = (
+        "Initial load in new tables, the primary keys are built at the end. "
+        "Only with the COPY backends"
+    )
+    compact = (
+        "Write in the compact tables, with lookup tables of the subreddits and "
+        "the authors. Only with the COPY backends"
+    )
+    skip_stale = (
+        "Look up the stored rows of each chunk and send only the records "
+        "retrieved after them"
+    )
+    metrics_file = (
+        "Write the metrics of the ingest in this file at every commit, "
+        "in the Prometheus text format"
+    )
+    metrics_port = "Serve the metrics on http://localhost:<port>/metrics"
+
+
+def open_backend(
+    backend: Backend,
+    connection_string: str,
+    parallelism: int = 1,
+    chunks_in_flight: int = 1,
+) -> IngestBackend:
+    module_name, class_name = BACKENDS[backend]
+    backend_class = getattr(importlib.import_module(module_name), class_name)
+    if parallelism == 1 and chunks_in_flight == 1:
+        return backend_class(connection_string)
+    return ParallelBackend(
+        [backend_class(connection_string) for _ in range(parallelism)],
+        chunks_in_flight,
+    )
+
+
+def commit(db: IngestBackend, manifest: Optional[IngestManifest], chunks: int):
+    with metrics.timer("commit"):
+        db.commit()
+    metrics.count("chunks_total", chunks)
+    if manifest is not None:
+        for _ in range(chunks):
+            manifest.chunk_loaded()
+
+
+def publish_metrics(db: IngestBackend, metrics_file: Optional[str]):
+    """Fetch the server timings for the metrics, and write them in the file"""
+    metrics.server_statements(db.server_timings())
+    if metrics_file is not None:
+        metrics.write(metrics_file)
+
+
+def upsert_compact(db: IngestBackend, keys: LookupKeys, submissions, comments):
+    """Look up the keys of the new names, then upsert in the compact tables"""
+    keys.resolve(db, submissions, comments)
+    db.upsert_compact(submissions, comments, keys)
+
+
+def main(
+    backend: Backend = Option(Backend.psycopg3_copy.value, help=HelpMessages.backend),
+    connection_string: str = Option(
+        CONNECTION_STRING,
+        envvar="INGEST_CONNECTION_STRING",
+        help=HelpMessages.connection_string,
+    ),
+    data_dir: str = Option("data", help=HelpMessages.data_dir),
+    chunk_size: int = Option(50000, help=HelpMessages.chunk_size),
+    chunk_mb: int = Option(
+        ChunkLimits.comment_bytes // (1024 * 1024), help=HelpMessages.chunk_mb
+    ),
+    processes: Optional[int] = Option(None, help=HelpMessages.processes),
+    prefetch: int = Option(1, help=HelpMessages.prefetch),
+    parallelism: int = Option(1, help=HelpMessages.parallelism),
+    chunks_in_flight: int = Option(1, help=HelpMessages.chunks_in_flight),
+    commit_every: int = Option(1, help=HelpMessages.commit_every),
+    incremental: bool = Option(False, help=HelpMessages.incremental),
+    manifest_path: str = Option(MANIFEST_PATH, help=HelpMessages.manifest),
+    partitioned: bool = Option(False, help=HelpMessages.partitioned),
+    bulk_load: bool = Option(False, help=HelpMessages.bulk_load),
+    skip_stale: bool = Option(False, help=HelpMessages.skip_stale),
+    compact: bool = Option(False, help=HelpMessages.compact),
+    metrics_file: Optional[str] = Option(None, help=HelpMessages.metrics_file),
+    metrics_port: Optional[int] = Option(None, help=HelpMessages.metrics_port),
+):
+    """
+    Ingest the downloaded data in Postgres, creating the tables if needed.
+
+    Existing rows are updated only by data retrieved later, so the same
+    files can be ingested again.
+
+    With --bulk-load the tables must not exist: the data is copied in them
+    without keys, the duplicates are removed and the keys built at the end.
+
+    With --compact the data goes in the compact_submission and
+    compact_comment tables instead, shown in full by the views
+    compact_submission_view and compact_comment_view.
+
+    The time spent in each stage, the rows and bytes per second and the queue
+    depths can be followed with --metrics-file or --metrics-port.
+    """
+    if (bulk_load or compact) and backend not in COPY_BACKENDS:
+        raise typer.BadParameter(
+            f"--bulk-load and --compact need one of the backends "
+            f"{', '.join(b.value for b in COPY_BACKENDS)}"
+        )
+    if chunks_in_flight > commit_every:
+        # the commit waits for the chunks in flight
+        raise typer.BadParameter("--chunks-in-flight can be at most --commit-every")
+    if bulk_load and skip_stale:
+        raise typer.BadParameter("--skip-stale is of no use with --bulk-load")
+    if compact and (partitioned or bulk_load or skip_stale):
+        raise typer.BadParameter(
+            "--compact does not support --partitioned, --bulk-load or --skip-stale"
+        )
+    manifest = IngestManifest(manifest_path) if incremental else None
+    db = open_backend(backend, connection_string, parallelism, chunks_in_flight)
+    publish = metrics_file is not None or metrics_port is not None
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    if compact:
+        write = partial(upsert_compact, db, LookupKeys())
+    elif bulk_load:
+        write = db.load
+    else:
+        write = db.upsert
+    total_subs, total_coms, skipped = 0, 0, 0
+    uncommitted = 0
+    try:
+        if compact:
+            db.create_compact_tables()
+        else:
+            db.create_tables(partitioned, primary_keys=not bulk_load)
+        for subs, coms in insertion_chunks(
+            chunk_size,
+            data_dir,
+            processes,
+            prefetch,
+            manifest,
+            submission_bytes=chunk_mb * 1024 * 1024,
+            comment_bytes=chunk_mb * 1024 * 1024,
+        ):
+            total_subs += len(subs)
+            total_coms += len(coms)
+            if skip_stale:
+                records = len(subs) + len(coms)
+                with metrics.timer("skip_stale"):
+                    subs = drop_stale(db, "submission", subs)
+                    coms = drop_stale(db, "comment", coms)
+                skipped += records - len(subs) - len(coms)
+                metrics.count("rows_skipped_total", records - len(subs) - len(coms))
+            with metrics.timer("write"):
+                write(subs, coms)
+            metrics.count("rows_written_total", len(subs), table="submission")
+            metrics.count("rows_written_total", len(coms), table="comment")
+            uncommitted += 1
+            if uncommitted == commit_every:
+                commit(db, manifest, uncommitted)
+                uncommitted = 0
+                if publish:
+                    publish_metrics(db, metrics_file)
+            logger.info(f"Submissions ingested so far: {total_subs}")
+            logger.info(f"Comments ingested so far: {total_coms}")
+            if skip_stale:
+                logger.info(f"Records already stored so far: {skipped}")
+        commit(db, manifest, uncommitted)
+        if bulk_load:
+            logger.info("Removing the duplicates and building the primary keys...")
+            db.execute(finish_bulk_load_statement(partitioned))
+        if publish:
+            publish_metrics(db, metrics_file)
+    except BaseException:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,263 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import chain
+from typing import Protocol
+
+from src.ingest_helper import Submission, Comment
+from src.ingest_schema import (
+    HAS_STAT_STATEMENTS,
+    SERVER_TIMINGS,
+    create_tables_statement,
+    retrieved_at_statement,
+)
+
+
+class IngestBackend(Protocol):
+    """
+    Writes the chunks in the DB, within a transaction committed by the caller.
+    The COPY backends can also `load` them, appending to tables without keys,
+    and `upsert_compact` them in the compact tables, with the keys returned by
+    their `lookup`
+    """
+
+    def create_tables(
+        self, partitioned: bool = False, primary_keys: bool = True
+    ) -> None:
+        ...
+
+    def upsert(
+        self, submissions: dict[str, Submission], comments: dict[str, Comment]
+    ) -> None:
+        ...
+
+    def execute(self, statement: str) -> None:
+        """Run a statement in its own transaction"""
+        ...
+
+    def retrieved_at(self, table: str, ids: list[str]) -> dict:
+        """The retrieval time of the stored rows with these ids"""
+        ...
+
+    def server_timings(self) -> list[tuple]:
+        """
+        The query, calls, seconds and rows of the statements writing the data,
+        from pg_stat_statements, or none when it is not installed
+        """
+        ...
+
+    def commit(self) -> None:
+        ...
+
+    def rollback(self) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+class DBAPIBackend:
+    """The common part of the backends with a DB-API connection in `conn`"""
+
+    conn = None
+
+    def create_tables(self, partitioned: bool = False, primary_keys: bool = True):
+        self.execute(create_tables_statement(partitioned, primary_keys))
+
+    def execute(self, statement: str):
+        with self.conn.cursor() as cur:
+            cur.execute(statement)
+        self.conn.commit()
+
+    def retrieved_at(self, table: str, ids: list[str]) -> dict:
+        with self.conn.cursor() as cur:
+            cur.execute(retrieved_at_statement(table, "%s"), (ids,))
+            return dict(cur.fetchall())
+
+    def server_timings(self) -> list[tuple]:
+        with self.conn.cursor() as cur:
+            cur.execute(HAS_STAT_STATEMENTS)
+            if not cur.fetchone()[0]:
+                return []
+            cur.execute(SERVER_TIMINGS)
+            return cur.fetchall()
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+def drop_stale(db: IngestBackend, table: str, records: dict) -> dict:
+    """
+    The records retrieved after the stored ones, or not stored at all.
+    The others would not change the table, so they are not sent
+    """
+    stored = db.retrieved_at(table, list(records))
+    return {
+        record_id: record
+        for record_id, record in records.items()
+        if record_id not in stored or stored[record_id] < record.retrieved_at
+    }
+
+
+class LookupKeys:
+    """
+    The integer keys of the subreddits and the authors in the compact tables.
+    They are cached for the whole ingest, only the new names are looked up
+    """
+
+    def __init__(self):
+        self.subreddits: dict[str, int] = {}
+        self.authors: dict[str, int] = {}
+
+    def resolve(
+        self,
+        db: IngestBackend,
+        submissions: dict[str, Submission],
+        comments: dict[str, Comment],
+    ):
+        """Look up the keys of the names of the chunk not seen yet, in bulk"""
+        records = list(chain(submissions.values(), comments.values()))
+        fetch_keys(db, "subreddit", self.subreddits, {r.subreddit for r in records})
+        fetch_keys(db, "author", self.authors, {r.author for r in records})
+
+
+def fetch_keys(db: IngestBackend, table: str, keys: dict[str, int], names: set):
+    missing = names - keys.keys()
+    # the names added by a concurrent ingest are found once it commits
+    while missing:
+        found = db.lookup(table, sorted(missing))
+        keys.update(found)
+        missing -= found.keys()
+
+
+def partition(records: dict, parts: int) -> list[dict]:
+    """Split the records in disjoint parts, by hash of the id"""
+    partitions = [{} for _ in range(parts)]
+    for record_id, record in records.items():
+        partitions[hash(record_id) % parts][record_id] = record
+    return partitions
+
+
+class ParallelBackend:
+    """
+    Write each chunk over many backends at once, each one with its own part
+    of the records. The parts are split by id, the same record always goes to
+    the same backend, so they never wait for the row locks of each other.
+    Up to `chunks_in_flight` chunks are written at the same time: a backend
+    starts its part of the next chunk without waiting for the others to be
+    done with the current one. The other calls, like the commit, wait for
+    the chunks in flight first.
+    The first error of a chunk is raised once all the backends are done with
+    it, and they all roll back. The commit is not atomic, each connection
+    commits its own transaction: if one fails, the parts committed before it
+    stay, the chunk is not marked as ingested in the manifest and the next
+    ingest writes it again. The upserts keep the latest retrieval, so writing
+    a chunk twice leaves the tables as writing it once (a failed --bulk-load
+    starts again from new tables anyway)
+    """
+
+    def __init__(self, backends: list[IngestBackend], chunks_in_flight: int = 1):
+        self.backends = backends
+        self.chunks_in_flight = chunks_in_flight
+        # a thread per backend, it writes its parts in the order of the chunks
+        self.executors = [ThreadPoolExecutor(max_workers=1) for _ in backends]
+        # the futures of the parts of every chunk in flight, oldest first
+        self.in_flight: deque[list[Future]] = deque()
+
+    def create_tables(self, partitioned: bool = False, primary_keys: bool = True):
+        self.wait_for_chunks()
+        # one at a time, the staging tables need the tables to exist
+        self.backends[0].create_tables(partitioned, primary_keys)
+        for backend in self.backends[1:]:
+            # the tables exist, this only creates the staging ones
+            backend.create_tables(partitioned)
+
+    def upsert(self, submissions: dict[str, Submission], comments: dict[str, Comment]):
+        self.spread("upsert", submissions, comments)
+
+    def load(self, submissions: dict[str, Submission], comments: dict[str, Comment]):
+        self.spread("load", submissions, comments)
+
+    def execute(self, statement: str):
+        self.wait_for_chunks()
+        # the tables are shared, once is enough
+        self.backends[0].execute(statement)
+
+    def retrieved_at(self, table: str, ids: list[str]) -> dict:
+        self.wait_for_chunks()
+        return self.backends[0].retrieved_at(table, ids)
+
+    def create_compact_tables(self):
+        self.wait_for_chunks()
+        for backend in self.backends:
+            backend.create_compact_tables()
+
+    def lookup(self, table: str, names: list[str]) -> dict[str, int]:
+        # a backend is not used by two threads at once
+        self.wait_for_chunks()
+        return self.backends[0].lookup(table, names)
+
+    def server_timings(self) -> list[tuple]:
+        self.wait_for_chunks()
+        # the statistics are of the whole DB
+        return self.backends[0].server_timings()
+
+    def upsert_compact(
+        self,
+        submissions: dict[str, Submission],
+        comments: dict[str, Comment],
+        keys: LookupKeys,
+    ):
+        self.spread("upsert_compact", submissions, comments, keys)
+
+    def spread(self, method: str, submissions: dict, comments: dict, *args):
+        """
+        Call the method of every backend with its part of the records, and
+        return once fewer than `chunks_in_flight` chunks are being written
+        """
+        parts = len(self.backends)
+        self.in_flight.append(
+            [
+                executor.submit(getattr(backend, method), subs, coms, *args)
+                for executor, backend, subs, coms in zip(
+                    self.executors,
+                    self.backends,
+                    partition(submissions, parts),
+                    partition(comments, parts),
+                )
+            ]
+        )
+        self.wait_for_chunks(self.chunks_in_flight - 1)
+
+    def wait_for_chunks(self, chunks: int = 0):
+        """Wait until at most `chunks` are in flight, raise their first error"""
+        while len(self.in_flight) > chunks:
+            futures = self.in_flight.popleft()
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                raise errors[0]
+
+    def commit(self):
+        self.wait_for_chunks()
+        # after a failure the caller rolls back the backends not committed yet
+        for backend in self.backends:
+            backend.commit()
+
+    def rollback(self):
+        # the chunks still in flight are rolled back too, their errors with them
+        for futures in self.in_flight:
+            wait(futures)
+        self.in_flight.clear()
+        for backend in self.backends:
+            backend.rollback()
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
+        for backend in self.backends:
+            backend.close()
@@ -0,0 +1,161 @@
+import struct
+from time import perf_counter
+from typing import Optional
+
+from src.ingest_helper import Submission, Comment
+from src.ingest_metrics import metrics
+
+# the PostgreSQL binary COPY format, built here in large buffers instead of
+# letting the driver adapt every value of every row
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+BUFFER_SIZE = 1024 * 1024
+
+# 2000-01-01, the origin of the timestamps
+PSQL_EPOCH = 946684800
+
+_length = struct.Struct(">i")
+# the length of the field and the value, in a single call
+_int4 = struct.Struct(">ii")
+_timestamp = struct.Struct(">iq")
+_int8 = _timestamp
+NULL = _length.pack(-1)
+TRUE = _length.pack(1) + b"\x01"
+FALSE = _length.pack(1) + b"\x00"
+SUBMISSION_FIELDS = struct.pack(">h", 11)
+COMMENT_FIELDS = struct.pack(">h", 9)
+
+
+def text(value: Optional[str]) -> bytes:
+    if value is None:
+        return NULL
+    encoded = value.encode()
+    return _length.pack(len(encoded)) + encoded
+
+
+def timestamp(value: int) -> bytes:
+    """Microseconds since 2000-01-01"""
+    return _timestamp.pack(8, int((value - PSQL_EPOCH) * 1000000))
+
+
+def bigint(value: int) -> bytes:
+    return _int8.pack(8, value)
+
+
+def relative_permalink(permalink: str, subreddit: str) -> str:
+    """
+    The permalink without the /r/<subreddit>/comments/ prefix, the compact
+    views add it back. Permalinks of another form are kept whole
+    """
+    prefix = f"/r/{subreddit}/comments/"
+    if permalink.startswith(prefix):
+        return permalink[len(prefix) :]
+    return permalink
+
+
+def submission_tuple(s: Submission) -> bytes:
+    return b"".join(
+        (
+            SUBMISSION_FIELDS,
+            text(s.id),
+            text(s.subreddit),
+            text(s.author),
+            timestamp(s.created_utc),
+            text(s.title),
+            timestamp(s.retrieved_at),
+            _int4.pack(4, s.score),
+            text(s.permalink),
+            TRUE if s.locked else FALSE,
+            text(s.selftext),
+            text(s.link),
+        )
+    )
+
+
+def comment_tuple(c: Comment) -> bytes:
+    return b"".join(
+        (
+            COMMENT_FIELDS,
+            text(c.id),
+            text(c.subreddit),
+            text(c.author),
+            text(c.body),
+            timestamp(c.created_utc),
+            text(c.parent_id),
+            text(c.permalink),
+            _int4.pack(4, c.score),
+            timestamp(c.retrieved_at),
+        )
+    )
+
+
+def compact_submission_tuple(
+    s: Submission, subreddits: dict[str, int], authors: dict[str, int]
+) -> bytes:
+    """The row of the compact table, the ids decoded from base 36"""
+    return b"".join(
+        (
+            SUBMISSION_FIELDS,
+            bigint(int(s.id, 36)),
+            _int4.pack(4, subreddits[s.subreddit]),
+            _int4.pack(4, authors[s.author]),
+            timestamp(s.created_utc),
+            text(s.title),
+            timestamp(s.retrieved_at),
+            _int4.pack(4, s.score),
+            text(relative_permalink(s.permalink, s.subreddit)),
+            TRUE if s.locked else FALSE,
+            text(s.selftext),
+            text(s.link),
+        )
+    )
+
+
+def compact_comment_tuple(
+    c: Comment, subreddits: dict[str, int], authors: dict[str, int]
+) -> bytes:
+    return b"".join(
+        (
+            COMMENT_FIELDS,
+            bigint(int(c.id, 36)),
+            _int4.pack(4, subreddits[c.subreddit]),
+            _int4.pack(4, authors[c.author]),
+            text(c.body),
+            timestamp(c.created_utc),
+            text(c.parent_id),
+            text(relative_permalink(c.permalink, c.subreddit)),
+            _int4.pack(4, c.score),
+            timestamp(c.retrieved_at),
+        )
+    )
+
+
+def copy_buffers(records, encode, buffer_size: int = BUFFER_SIZE):
+    """
+    The binary COPY data of the records, in the column order of the table,
+    yielded in buffers of about `buffer_size` bytes.
+    The encoding time, not counting the sending, is the encode stage
+    """
+    tuples = [COPY_HEADER]
+    size = 0
+    encoding = 0.0
+    start = perf_counter()
+    for record in records:
+        encoded = encode(record)
+        tuples.append(encoded)
+        size += len(encoded)
+        if size >= buffer_size:
+            buffer = b"".join(tuples)
+            encoding += perf_counter() - start
+            metrics.count("copy_bytes_total", len(buffer))
+            yield buffer
+            start = perf_counter()
+            tuples = []
+            size = 0
+    tuples.append(COPY_TRAILER)
+    buffer = b"".join(tuples)
+    metrics.observe("encode", encoding + perf_counter() - start)
+    metrics.count("copy_bytes_total", len(buffer))
+    yield buffer
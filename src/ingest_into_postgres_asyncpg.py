@@ -1,152 +1,265 @@
 import asyncio
-from datetime import datetime
+from functools import partial
 
 import asyncpg
-from loguru import logger
 
-from src.ingest_helper import Submission, Comment, insertion_chunks, CONNECTION_STRING
+from src.ingest_backend import LookupKeys
+from src.ingest_copy import (
+    comment_tuple,
+    compact_comment_tuple,
+    compact_submission_tuple,
+    copy_buffers,
+    submission_tuple,
+)
+from src.ingest_helper import Submission, Comment
+from src.ingest_metrics import metrics
+from src.ingest_schema import (
+    COMMENT_COLUMNS,
+    COMPACT_COMMENT_COLUMNS,
+    COMPACT_SUBMISSION_COLUMNS,
+    CREATE_COMPACT_TABLES,
+    HAS_STAT_STATEMENTS,
+    SERVER_TIMINGS,
+    SUBMISSION_COLUMNS,
+    comment_row,
+    create_tables_statement,
+    lookup_statement,
+    retrieved_at_statement,
+    submission_row,
+    upsert_statement,
+)
 
 # currently it takes 36 minutes to ingest 4.9M comments
+# with executemany, the asyncpg-copy backend uses COPY instead
 
 
-async def get_connection():
-    return await asyncpg.connect(dsn=CONNECTION_STRING)
-
-
-async def create_tables(conn):
-    await conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS submission (
-            id           TEXT PRIMARY KEY,
-            subreddit    TEXT,
-            author       TEXT,
-            created_utc  TIMESTAMP WITH TIME ZONE,
-            title        TEXT,
-            retrieved_at TIMESTAMP WITH TIME ZONE,
-            score        INTEGER,
-            permalink    TEXT,
-            LOCKED       BOOLEAN,
-            selftext     TEXT,
-            link         TEXT
-        );
-        CREATE TABLE IF NOT EXISTS comment (
-            id           TEXT PRIMARY KEY,
-            subreddit    TEXT,
-            author       TEXT,
-            body         TEXT,
-            created_utc  TIMESTAMP WITH TIME ZONE,
-            parent_id    TEXT,
-            permalink    TEXT,
-            score        INTEGER,
-            retrieved_at TIMESTAMP WITH TIME ZONE
-        );
-     """
-    )
+async def create_tables(conn, partitioned: bool = False, primary_keys: bool = True):
+    await conn.execute(create_tables_statement(partitioned, primary_keys))
 
 
 async def upsert_submissions(conn, submissions: dict[str, Submission]):
     stm = await conn.prepare(
-        """
-         INSERT INTO submission AS old (
-            id,
-            subreddit,
-            author,
-            created_utc,
-            title,
-            retrieved_at,
-            score,
-            permalink,
-            locked,
-            selftext,
-            link
-         ) VALUES ($1, $2, $3,$4, $5, $6, $7, $8, $9, $10, $11)
-        ON CONFLICT(id) DO UPDATE SET
-            author = EXCLUDED.author,
-            subreddit = EXCLUDED.subreddit,
-            created_utc = EXCLUDED.created_utc,
-            title = EXCLUDED.title,
-            retrieved_at = EXCLUDED.retrieved_at,
-            score = EXCLUDED.score,
-            permalink = EXCLUDED.permalink,
-            locked = EXCLUDED.locked,
-            selftext = EXCLUDED.selftext,
-            link = EXCLUDED.link
-        WHERE EXCLUDED.retrieved_at >= old.retrieved_at;
-     """
-    )
-    subs = []
-    for s in submissions.values():
-        subs.append(
-            [
-                s.id,
-                s.subreddit,
-                s.author,
-                datetime.fromtimestamp(s.created_utc),
-                s.title,
-                datetime.fromtimestamp(s.retrieved_at),
-                s.score,
-                s.permalink,
-                s.locked,
-                s.selftext,
-                s.link,
-            ]
+        upsert_statement(
+            "submission",
+            SUBMISSION_COLUMNS,
+            "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)",
         )
-    await stm.executemany(subs)
+    )
+    with metrics.timer("execute"):
+        await stm.executemany(submission_row(s) for s in submissions.values())
 
 
 async def upsert_comments(conn, comments: dict[str, Comment]):
     stm = await conn.prepare(
-        """
-         INSERT INTO comment AS old (
-            id,
-            subreddit,
-            author,
-            body,
-            created_utc,
-            parent_id,
-            permalink,
-            score,
-            retrieved_at
-         ) VALUES ($1, $2, $3,$4, $5, $6, $7, $8, $9)
-        ON CONFLICT(id) DO UPDATE SET
-            author = EXCLUDED.author,
-            subreddit = EXCLUDED.subreddit,
-            body = EXCLUDED.body,
-            created_utc = EXCLUDED.created_utc,
-            parent_id = EXCLUDED.parent_id,
-            permalink = EXCLUDED.permalink,
-            score = EXCLUDED.score,
-            retrieved_at = EXCLUDED.retrieved_at
-        WHERE EXCLUDED.retrieved_at >= old.retrieved_at;
-     """
+        upsert_statement(
+            "comment", COMMENT_COLUMNS, "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)"
+        )
+    )
+    with metrics.timer("execute"):
+        await stm.executemany(comment_row(c) for c in comments.values())
+
+
+async def create_staging_tables(conn, tables=("submission", "comment")):
+    """
+    Create the staging tables of the session, reused for all the chunks.
+    Being temporary they are private to the connection and not WAL-logged
+    """
+    for table in tables:
+        await conn.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS new_{table} (LIKE {table})"
+        )
+
+
+async def stream(buffers):
+    for buffer in buffers:
+        yield buffer
+
+
+async def copy_into(conn, table: str, columns: list[str], buffers):
+    with metrics.timer("copy"):
+        await conn.copy_to_table(
+            table, source=stream(buffers), columns=columns, format="binary"
+        )
+
+
+async def copy_upsert(conn, table: str, columns: list[str], buffers):
+    """COPY the binary data in the staging table, then merge it in the table"""
+    staging = f"new_{table}"
+    await conn.execute(f"TRUNCATE {staging}")
+    await copy_into(conn, staging, columns, buffers)
+    # in the id order, the parallel connections lock the rows in the same order
+    with metrics.timer("merge_sql"):
+        await conn.execute(
+            upsert_statement(table, columns, f"SELECT * FROM {staging} ORDER BY id")
+        )
+
+
+async def copy_upsert_submissions(conn, submissions: dict[str, Submission]):
+    await copy_upsert(
+        conn,
+        "submission",
+        SUBMISSION_COLUMNS,
+        copy_buffers(submissions.values(), submission_tuple),
+    )
+
+
+async def copy_upsert_comments(conn, comments: dict[str, Comment]):
+    await copy_upsert(
+        conn,
+        "comment",
+        COMMENT_COLUMNS,
+        copy_buffers(comments.values(), comment_tuple),
+    )
+
+
+async def copy_upsert_compact(
+    conn,
+    submissions: dict[str, Submission],
+    comments: dict[str, Comment],
+    keys: LookupKeys,
+):
+    await copy_upsert(
+        conn,
+        "compact_submission",
+        COMPACT_SUBMISSION_COLUMNS,
+        copy_buffers(
+            submissions.values(),
+            partial(
+                compact_submission_tuple,
+                subreddits=keys.subreddits,
+                authors=keys.authors,
+            ),
+        ),
+    )
+    await copy_upsert(
+        conn,
+        "compact_comment",
+        COMPACT_COMMENT_COLUMNS,
+        copy_buffers(
+            comments.values(),
+            partial(
+                compact_comment_tuple, subreddits=keys.subreddits, authors=keys.authors
+            ),
+        ),
+    )
+
+
+async def load(conn, submissions: dict[str, Submission], comments: dict[str, Comment]):
+    """COPY straight in the tables, for a bulk load without keys"""
+    await copy_into(
+        conn,
+        "submission",
+        SUBMISSION_COLUMNS,
+        copy_buffers(submissions.values(), submission_tuple),
     )
-    coms = []
-    for c in comments.values():
-        coms.append(
-            [
-                c.id,
-                c.subreddit,
-                c.author,
-                c.body,
-                datetime.fromtimestamp(c.created_utc),
-                c.parent_id,
-                c.permalink,
-                c.score,
-                datetime.fromtimestamp(c.retrieved_at),
-            ]
+    await copy_into(
+        conn,
+        "comment",
+        COMMENT_COLUMNS,
+        copy_buffers(comments.values(), comment_tuple),
+    )
+
+
+class AsyncpgBackend:
+    """
+    executemany of prepared statements.
+    The connection has its own event loop, so the backend can be used as the
+    synchronous ones, also from another thread
+    """
+
+    def __init__(self, connection_string: str):
+        self.connection_string = connection_string
+        self.loop = asyncio.new_event_loop()
+        self.conn = self.run(asyncpg.connect(dsn=connection_string))
+        self.transaction = None
+        # outside of a transaction, for the lookups
+        self.lookup_conn = None
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def create_tables(self, partitioned: bool = False, primary_keys: bool = True):
+        self.run(create_tables(self.conn, partitioned, primary_keys))
+
+    def execute(self, statement: str):
+        self.run(self.conn.execute(statement))
+
+    def retrieved_at(self, table: str, ids: list[str]) -> dict:
+        rows = self.run(
+            self.conn.fetch(retrieved_at_statement(table, "$1::text[]"), ids)
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def lookup(self, table: str, names: list[str]) -> dict[str, int]:
+        # on a connection of its own, the new names are committed at once
+        # instead of being locked until the chunk is
+        if self.lookup_conn is None:
+            self.lookup_conn = self.run(asyncpg.connect(dsn=self.connection_string))
+        rows = self.run(
+            self.lookup_conn.fetch(lookup_statement(table, "$1::text[]"), names)
+        )
+        return {row[0]: row[1] for row in rows}
+
+    def server_timings(self) -> list[tuple]:
+        if not self.run(self.conn.fetchval(HAS_STAT_STATEMENTS)):
+            return []
+        return [tuple(row) for row in self.run(self.conn.fetch(SERVER_TIMINGS))]
+
+    def begin(self):
+        if self.transaction is None:
+            self.transaction = self.conn.transaction()
+            self.run(self.transaction.start())
+
+    def upsert(self, submissions: dict[str, Submission], comments: dict[str, Comment]):
+        self.begin()
+        self.run(upsert_submissions(self.conn, submissions))
+        self.run(upsert_comments(self.conn, comments))
+
+    def commit(self):
+        if self.transaction is not None:
+            self.run(self.transaction.commit())
+            self.transaction = None
+
+    def rollback(self):
+        if self.transaction is not None:
+            self.run(self.transaction.rollback())
+            self.transaction = None
+
+    def close(self):
+        self.run(self.conn.close())
+        if self.lookup_conn is not None:
+            self.run(self.lookup_conn.close())
+        self.loop.close()
+
+
+class AsyncpgCopyBackend(AsyncpgBackend):
+    """COPY in temporary staging tables, merged with a single statement"""
+
+    def create_tables(self, partitioned: bool = False, primary_keys: bool = True):
+        super().create_tables(partitioned, primary_keys)
+        self.run(create_staging_tables(self.conn))
+
+    def upsert(self, submissions: dict[str, Submission], comments: dict[str, Comment]):
+        self.begin()
+        self.run(copy_upsert_submissions(self.conn, submissions))
+        self.run(copy_upsert_comments(self.conn, comments))
+
+    def load(self, submissions: dict[str, Submission], comments: dict[str, Comment]):
+        self.begin()
+        self.run(load(self.conn, submissions, comments))
+
+    def create_compact_tables(self):
+        self.execute(CREATE_COMPACT_TABLES)
+        self.run(
+            create_staging_tables(self.conn, ("compact_submission", "compact_comment"))
         )
-    await stm.executemany(coms)
-
-
-if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    conn = loop.run_until_complete(get_connection())
-    loop.run_until_complete(create_tables(conn))
-    total_subs, total_coms = 0, 0
-    for subs, coms in insertion_chunks():
-        total_subs += len(subs)
-        total_coms += len(coms)
-        loop.run_until_complete(upsert_submissions(conn, subs))
-        logger.info(f"Submissions ingested so far: {total_subs}")
-        loop.run_until_complete(upsert_comments(conn, coms))
-        logger.info(f"Comments ingested so far: {total_coms}")
+
+    def upsert_compact(
+        self,
+        submissions: dict[str, Submission],
+        comments: dict[str, Comment],
+        keys: LookupKeys,
+    ):
+        """Upsert in the compact tables, `keys` has the names of the chunk"""
+        self.begin()
+        self.run(copy_upsert_compact(self.conn, submissions, comments, keys))
@@ -1,179 +1,166 @@
-from datetime import datetime
-import struct
+from functools import partial
 
 import psycopg3
-from loguru import logger
 
-from src.ingest_helper import Submission, Comment, insertion_chunks, CONNECTION_STRING
-
-
-def get_connection():
-    return psycopg3.connect(CONNECTION_STRING)
-
-
-PSQL_EPOCH = 946684800
+from src.ingest_backend import DBAPIBackend, LookupKeys
+from src.ingest_copy import (
+    comment_tuple,
+    compact_comment_tuple,
+    compact_submission_tuple,
+    copy_buffers,
+    submission_tuple,
+)
+from src.ingest_helper import Submission, Comment
+from src.ingest_metrics import metrics
+from src.ingest_schema import (
+    COMMENT_COLUMNS,
+    COMPACT_COMMENT_COLUMNS,
+    COMPACT_SUBMISSION_COLUMNS,
+    CREATE_COMPACT_TABLES,
+    SUBMISSION_COLUMNS,
+    lookup_statement,
+    upsert_statement,
+)
+
+
+def create_staging_tables(conn, tables=("submission", "comment")):
+    """
+    Create the staging tables of the session, reused for all the chunks.
+    Being temporary they are private to the connection and not WAL-logged
+    """
+    with conn.cursor() as cur:
+        for table in tables:
+            cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS new_{table} (LIKE {table});")
+    conn.commit()
 
 
-def timestamp_to_binary(dt: int):
-    return struct.pack(">q", int((dt - PSQL_EPOCH) * 10 ** 6))
+def copy_into(conn, table: str, columns: list[str], buffers):
+    with metrics.timer("copy"), conn.cursor() as cur:
+        with cur.copy(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH BINARY"
+        ) as copy:
+            for buffer in buffers:
+                copy.write(buffer)
 
 
-def create_tables(conn):
+def copy_upsert(conn, table: str, columns: list[str], buffers):
+    """COPY the binary data in the staging table, then merge it in the table"""
+    staging = f"new_{table}"
     with conn.cursor() as cur:
+        cur.execute(f"TRUNCATE {staging};")
+    copy_into(conn, staging, columns, buffers)
+    with metrics.timer("merge_sql"), conn.cursor() as cur:
+        # in the id order, the parallel connections lock the rows in the same order
         cur.execute(
-            """
-        CREATE TABLE IF NOT EXISTS submission (
-            id           TEXT PRIMARY KEY,
-            subreddit    TEXT,
-            author       TEXT,
-            created_utc  TIMESTAMP WITH TIME ZONE,
-            title        TEXT,
-            retrieved_at TIMESTAMP WITH TIME ZONE,
-            score        INTEGER,
-            permalink    TEXT,
-            LOCKED       BOOLEAN,
-            selftext     TEXT,
-            link         TEXT
-        );
-        CREATE TABLE IF NOT EXISTS comment (
-            id           TEXT PRIMARY KEY,
-            subreddit    TEXT,
-            author       TEXT,
-            body         TEXT,
-            created_utc  TIMESTAMP WITH TIME ZONE,
-            parent_id    TEXT,
-            permalink    TEXT,
-            score        INTEGER,
-            retrieved_at TIMESTAMP WITH TIME ZONE
-        );
-     """
+            upsert_statement(table, columns, f"SELECT * FROM {staging} ORDER BY id")
         )
 
 
 def upsert_submissions(conn, submissions: dict[str, Submission]):
-    with conn.cursor(binary=True) as cur:
-        cur.execute(
-            """
-        CREATE UNLOGGED TABLE new_submission AS SELECT * FROM submission WHERE FALSE;
-        """
-        )
-        with cur.copy("COPY new_submission FROM STDIN WITH BINARY") as copy:
-            for s in submissions.values():
-                copy.write_row(
-                    (
-                        s.id,
-                        s.subreddit,
-                        s.author,
-                        # datetime.fromtimestamp(s.created_utc),
-                        timestamp_to_binary(s.created_utc),
-                        s.title,
-                        # datetime.fromtimestamp(s.retrieved_at),
-                        timestamp_to_binary(s.retrieved_at),
-                        s.score,
-                        s.permalink,
-                        s.locked,
-                        s.selftext,
-                        s.link,
-                    )
-                )
-    stm = """
-        INSERT INTO submission AS old (
-                    id,
-                    subreddit,
-                    author,
-                    created_utc,
-                    title,
-                    retrieved_at,
-                    score,
-                    permalink,
-                    locked,
-                    selftext,
-                    link)
-        SELECT * FROM new_submission
-        ON CONFLICT(id) DO UPDATE SET
-                author       = EXCLUDED.author,
-                subreddit    = EXCLUDED.subreddit,
-                created_utc  = EXCLUDED.created_utc,
-                title        = EXCLUDED.title,
-                retrieved_at = EXCLUDED.retrieved_at,
-                score        = EXCLUDED.score,
-                permalink    = EXCLUDED.permalink,
-                locked       = EXCLUDED.locked,
-                selftext     = EXCLUDED.selftext,
-                link         = EXCLUDED.link
-        WHERE
-            EXCLUDED.retrieved_at >= old.retrieved_at;
-     """
+    copy_upsert(
+        conn,
+        "submission",
+        SUBMISSION_COLUMNS,
+        copy_buffers(submissions.values(), submission_tuple),
+    )
 
-    with conn.cursor() as cur:
-        cur.execute(stm)
-        cur.execute("DROP TABLE new_submission;")
 
-    conn.commit()
+def upsert_comments(conn, comments: dict[str, Comment]):
+    copy_upsert(
+        conn,
+        "comment",
+        COMMENT_COLUMNS,
+        copy_buffers(comments.values(), comment_tuple),
+    )
 
 
-def upsert_comments(conn, comments: dict[str, Comment]):
-    with conn.cursor(binary=True) as cur:
-        cur.execute(
-            """
-        CREATE UNLOGGED TABLE new_comment AS SELECT * FROM comment WHERE FALSE;
+class Psycopg3CopyBackend(DBAPIBackend):
+    """Binary COPY in temporary staging tables, merged with a single statement"""
+
+    def __init__(self, connection_string: str):
+        self.connection_string = connection_string
+        self.conn = psycopg3.connect(connection_string)
+        # in autocommit, for the lookups
+        self.lookup_conn = None
+
+    def create_tables(self, partitioned: bool = False, primary_keys: bool = True):
+        super().create_tables(partitioned, primary_keys)
+        create_staging_tables(self.conn)
+
+    def upsert(self, submissions: dict[str, Submission], comments: dict[str, Comment]):
+        upsert_submissions(self.conn, submissions)
+        upsert_comments(self.conn, comments)
+
+    def create_compact_tables(self):
+        self.execute(CREATE_COMPACT_TABLES)
+        create_staging_tables(self.conn, ("compact_submission", "compact_comment"))
+
+    def lookup(self, table: str, names: list[str]) -> dict[str, int]:
+        """
+        Add the missing names to a lookup table and return the keys of all.
+        On a connection of its own in autocommit, the new names are committed
+        at once instead of being locked until the chunk is
         """
+        if self.lookup_conn is None:
+            self.lookup_conn = psycopg3.connect(self.connection_string)
+            self.lookup_conn.autocommit = True
+        with self.lookup_conn.cursor() as cur:
+            # the array is used twice, by name
+            cur.execute(
+                lookup_statement(table, "%(names)s::text[]"), {"names": names}
+            )
+            return dict(cur.fetchall())
+
+    def upsert_compact(
+        self,
+        submissions: dict[str, Submission],
+        comments: dict[str, Comment],
+        keys: LookupKeys,
+    ):
+        """Upsert in the compact tables, `keys` has the names of the chunk"""
+        copy_upsert(
+            self.conn,
+            "compact_submission",
+            COMPACT_SUBMISSION_COLUMNS,
+            copy_buffers(
+                submissions.values(),
+                partial(
+                    compact_submission_tuple,
+                    subreddits=keys.subreddits,
+                    authors=keys.authors,
+                ),
+            ),
+        )
+        copy_upsert(
+            self.conn,
+            "compact_comment",
+            COMPACT_COMMENT_COLUMNS,
+            copy_buffers(
+                comments.values(),
+                partial(
+                    compact_comment_tuple,
+                    subreddits=keys.subreddits,
+                    authors=keys.authors,
+                ),
+            ),
         )
-        with cur.copy("COPY new_comment FROM STDIN WITH BINARY") as copy:
-            for c in comments.values():
-                copy.write_row(
-                    (
-                        c.id,
-                        c.subreddit,
-                        c.author,
-                        c.body,
-                        # datetime.fromtimestamp(c.created_utc),
-                        timestamp_to_binary(c.created_utc),
-                        c.parent_id,
-                        c.permalink,
-                        c.score,
-                        # datetime.fromtimestamp(c.retrieved_at),
-                        timestamp_to_binary(c.retrieved_at),
-                    )
-                )
-    stm = """
-         INSERT INTO comment AS old (
-            id,
-            subreddit,
-            author,
-            body,
-            created_utc,
-            parent_id,
-            permalink,
-            score,
-            retrieved_at
-         ) SELECT * FROM new_comment
-        ON CONFLICT(id) DO UPDATE SET
-            author = EXCLUDED.author,
-            subreddit = EXCLUDED.subreddit,
-            body = EXCLUDED.body,
-            created_utc = EXCLUDED.created_utc,
-            parent_id = EXCLUDED.parent_id,
-            permalink = EXCLUDED.permalink,
-            score = EXCLUDED.score,
-            retrieved_at = EXCLUDED.retrieved_at
-        WHERE EXCLUDED.retrieved_at >= old.retrieved_at;
-     """
-
-    with conn.cursor() as cur:
-        cur.execute(stm)
-        cur.execute("DROP TABLE new_comment;")
-    conn.commit()
 
+    def load(self, submissions: dict[str, Submission], comments: dict[str, Comment]):
+        """COPY straight in the tables, for a bulk load without keys"""
+        copy_into(
+            self.conn,
+            "submission",
+            SUBMISSION_COLUMNS,
+            copy_buffers(submissions.values(), submission_tuple),
+        )
+        copy_into(
+            self.conn,
+            "comment",
+            COMMENT_COLUMNS,
+            copy_buffers(comments.values(), comment_tuple),
+        )
 
-if __name__ == "__main__":
-    conn = get_connection()
-    create_tables(conn)
-    total_subs, total_coms = 0, 0
-    for subs, coms in insertion_chunks():
-        total_subs += len(subs)
-        total_coms += len(coms)
-        upsert_submissions(conn, subs)
-        logger.info(f"Submissions ingested so far: {total_subs}")
-        upsert_comments(conn, coms)
-        logger.info(f"Comments ingested so far: {total_coms}")
+    def close(self):
+        super().close()
+        if self.lookup_conn is not None:
+            self.lookup_conn.close()
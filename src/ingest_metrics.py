@@ -0,0 +1,196 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from pathlib import Path
+import re
+from threading import Lock, Thread
+from time import perf_counter, time
+
+# the metrics of the ingest, in the Prometheus text format
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+
+PREFIX = "ingest_"
+# upper bounds of the buckets of the stage durations, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+HELP = {
+    "stage_seconds": (
+        "Duration of the stages of the ingest: parse and merge of the files, "
+        "encode, copy, merge_sql and execute in the backends, skip_stale, "
+        "write and commit of the chunks. copy includes the encoding of the "
+        "streamed data, write all the stages of the backend"
+    ),
+    "records_total": "Records read from the files, after deduplication",
+    "input_bytes_total": "Bytes of the JSON lines read",
+    "rows_written_total": "Rows sent to the DB",
+    "rows_skipped_total": "Rows not sent, not newer than the stored ones",
+    "copy_bytes_total": "Bytes of binary COPY data sent",
+    "chunks_total": "Chunks committed",
+    "prefetch_queue_depth": "Chunks parsed and waiting for the DB",
+    "parse_queue_depth": "Chunks parsed and waiting to be merged",
+    "parse_running_files": "Files being parsed by the parsing processes",
+    "elapsed_seconds": "Time since the start of the ingest",
+    "rows_written_per_second": "Rows sent to the DB per second, on average",
+    "input_bytes_per_second": "Bytes of the JSON lines read per second, on average",
+    "server_statement_calls": "Calls of the statement, from pg_stat_statements",
+    "server_statement_seconds": "Execution time of the statement in the server",
+    "server_statement_rows": "Rows affected by the statement",
+}
+# the averages per second of these counters, since the start
+THROUGHPUT = {
+    "rows_written_total": "rows_written_per_second",
+    "input_bytes_total": "input_bytes_per_second",
+}
+
+
+def labels_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def number(value: float) -> str:
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def statement_name(query: str) -> str:
+    """A short name of a statement, its command and its table"""
+    match = re.match(r"\s*(\w+)\s+(?:INTO\s+)?(\w+)", query, re.IGNORECASE)
+    return f"{match[1].upper()} {match[2]}" if match else query.split()[0]
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of the stage durations, shared by the
+    threads of the ingest
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.start_time = time()
+        self.counters: dict[tuple, float] = defaultdict(float)
+        self.gauges: dict[tuple, float] = {}
+        # stage -> the count of each bucket, the sum and the count
+        self.stages: dict[str, list] = {}
+
+    def count(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[name, tuple(sorted(labels.items()))] = value
+
+    def observe(self, stage: str, seconds: float):
+        with self.lock:
+            buckets, total, count = self.stages.get(stage, ([0] * len(BUCKETS), 0, 0))
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[index] += 1
+            self.stages[stage] = [buckets, total + seconds, count + 1]
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start)
+
+    def stage_seconds(self) -> dict[str, float]:
+        """The total time spent in each stage"""
+        with self.lock:
+            return {stage: total for stage, (_, total, _) in self.stages.items()}
+
+    def server_statements(self, timings: list[tuple]):
+        """Store the calls, seconds and rows of each statement from the server"""
+        totals = defaultdict(lambda: [0, 0.0, 0])
+        for query, calls, seconds, rows in timings:
+            total = totals[statement_name(query)]
+            total[0] += calls
+            total[1] += float(seconds)
+            total[2] += rows
+        for statement, (calls, seconds, rows) in totals.items():
+            self.set("server_statement_calls", calls, statement=statement)
+            self.set("server_statement_seconds", seconds, statement=statement)
+            self.set("server_statement_rows", rows, statement=statement)
+
+    def render(self) -> str:
+        elapsed = time() - self.start_time
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            stages = {
+                stage: (list(buckets), total, count)
+                for stage, (buckets, total, count) in self.stages.items()
+            }
+        gauges["elapsed_seconds", ()] = elapsed
+        for (name, labels), value in counters.items():
+            if name in THROUGHPUT:
+                gauges[THROUGHPUT[name], labels] = value / elapsed
+        lines = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.extend(header(name, kind))
+                for (other, labels), value in sorted(values.items()):
+                    if other == name:
+                        lines.append(
+                            f"{PREFIX}{name}{labels_text(labels)} {number(value)}"
+                        )
+        if stages:
+            lines.extend(header("stage_seconds", "histogram"))
+        for stage, (buckets, total, count) in sorted(stages.items()):
+            for bound, bucket in zip(BUCKETS, buckets):
+                lines.append(
+                    f'{PREFIX}stage_seconds_bucket{{stage="{stage}",le="{bound}"}} '
+                    f"{bucket}"
+                )
+            lines.append(
+                f'{PREFIX}stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}'
+            )
+            lines.append(
+                f'{PREFIX}stage_seconds_sum{{stage="{stage}"}} {number(total)}'
+            )
+            lines.append(f'{PREFIX}stage_seconds_count{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """Write the metrics in a file, for the textfile collector of node_exporter"""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int):
+        """Serve the metrics on http://localhost:<port>/metrics, in a thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("localhost", port), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+
+
+def header(name: str, kind: str) -> list[str]:
+    lines = [f"# TYPE {PREFIX}{name} {kind}"]
+    if name in HELP:
+        lines.insert(0, f"# HELP {PREFIX}{name} {HELP[name]}")
+    return lines
+
+
+# the metrics of the process
+metrics = Metrics()
@@ -0,0 +1,316 @@
+from datetime import datetime
+
+from src.ingest_helper import Submission, Comment
+
+# the tables written by all the ingest backends, the rows are built in
+# the order of these columns
+SUBMISSION_COLUMNS = [
+    "id",
+    "subreddit",
+    "author",
+    "created_utc",
+    "title",
+    "retrieved_at",
+    "score",
+    "permalink",
+    "locked",
+    "selftext",
+    "link",
+]
+COMMENT_COLUMNS = [
+    "id",
+    "subreddit",
+    "author",
+    "body",
+    "created_utc",
+    "parent_id",
+    "permalink",
+    "score",
+    "retrieved_at",
+]
+
+SUBMISSION_TABLE = """
+            id           TEXT,
+            subreddit    TEXT,
+            author       TEXT,
+            created_utc  TIMESTAMP WITH TIME ZONE,
+            title        TEXT,
+            retrieved_at TIMESTAMP WITH TIME ZONE,
+            score        INTEGER,
+            permalink    TEXT,
+            LOCKED       BOOLEAN,
+            selftext     TEXT,
+            link         TEXT"""
+COMMENT_TABLE = """
+            id           TEXT,
+            subreddit    TEXT,
+            author       TEXT,
+            body         TEXT,
+            created_utc  TIMESTAMP WITH TIME ZONE,
+            parent_id    TEXT,
+            permalink    TEXT,
+            score        INTEGER,
+            retrieved_at TIMESTAMP WITH TIME ZONE"""
+# a partitioned table needs the partition key in the primary key, the
+# creation time of a comment never changes so the id is still unique
+PRIMARY_KEYS = {
+    ("submission", False): "id",
+    ("comment", False): "id",
+    ("comment", True): "id, created_utc",
+}
+# the yearly partitions of the comments, the default one takes the rest
+FIRST_YEAR = 2005
+
+
+def primary_key(table: str, partitioned: bool) -> str:
+    """The constraint is always named <table>_pkey, the target of the upserts"""
+    columns = PRIMARY_KEYS[table, partitioned and table == "comment"]
+    return f"CONSTRAINT {table}_pkey PRIMARY KEY ({columns})"
+
+
+def create_tables_statement(
+    partitioned: bool = False, primary_keys: bool = True
+) -> str:
+    """
+    Create the tables if they do not exist.
+    With `partitioned` the comments are partitioned by year of creation.
+    Without `primary_keys` the tables must not exist, the keys are added
+    at the end of the load by `finish_bulk_load_statement`
+    """
+    if primary_keys:
+        create = "CREATE TABLE IF NOT EXISTS"
+        submission_key = f",\n            {primary_key('submission', partitioned)}"
+        comment_key = f",\n            {primary_key('comment', partitioned)}"
+    else:
+        create, submission_key, comment_key = "CREATE TABLE", "", ""
+    statement = f"""
+        {create} submission ({SUBMISSION_TABLE}{submission_key}
+        );
+        {create} comment ({COMMENT_TABLE}{comment_key}
+        )"""
+    if not partitioned:
+        return statement + ";\n"
+    statement += " PARTITION BY RANGE (created_utc);\n"
+    for year in range(FIRST_YEAR, datetime.now().year + 2):
+        statement += (
+            f"        {create} comment_{year} PARTITION OF comment"
+            f" FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01');\n"
+        )
+    statement += f"        {create} comment_default PARTITION OF comment DEFAULT;\n"
+    return statement
+
+
+def finish_bulk_load_statement(partitioned: bool = False) -> str:
+    """
+    Remove the records loaded more than once keeping the one retrieved last,
+    then build the primary keys, once for all the rows
+    """
+    statement = ""
+    for table in ("submission", "comment"):
+        statement += f"""
+        DELETE FROM {table} AS old USING {table} AS new
+        WHERE old.id = new.id
+            AND (old.retrieved_at, old.ctid) < (new.retrieved_at, new.ctid);
+        ALTER TABLE {table} ADD {primary_key(table, partitioned)};
+        ANALYZE {table};"""
+    return statement
+
+
+def upsert_statement(table: str, columns: list[str], source: str) -> str:
+    """
+    Insert the rows of `source`, a VALUES or SELECT clause, in the table.
+    The existing rows are updated only by data retrieved later, they are
+    found by primary key, the id or the id and the partition key
+    """
+    updates = ",\n            ".join(
+        f"{column} = EXCLUDED.{column}" for column in columns if column != "id"
+    )
+    return f"""
+         INSERT INTO {table} AS old (
+            {", ".join(columns)}
+         ) {source}
+        ON CONFLICT ON CONSTRAINT {table}_pkey DO UPDATE SET
+            {updates}
+        WHERE EXCLUDED.retrieved_at >= old.retrieved_at;
+     """
+
+
+# the compact layout: the ids decoded from base 36, the subreddits and the
+# authors stored once in lookup tables, the permalinks without the
+# /r/<subreddit>/comments/ prefix. The views show the rows as the tables above
+COMPACT_SUBMISSION_COLUMNS = [
+    "id",
+    "subreddit_id",
+    "author_id",
+    "created_utc",
+    "title",
+    "retrieved_at",
+    "score",
+    "permalink",
+    "locked",
+    "selftext",
+    "link",
+]
+COMPACT_COMMENT_COLUMNS = [
+    "id",
+    "subreddit_id",
+    "author_id",
+    "body",
+    "created_utc",
+    "parent_id",
+    "permalink",
+    "score",
+    "retrieved_at",
+]
+CREATE_COMPACT_TABLES = """
+        CREATE TABLE IF NOT EXISTS subreddit (
+            id   SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS author (
+            id   SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS compact_submission (
+            id           BIGINT PRIMARY KEY,
+            subreddit_id INTEGER,
+            author_id    INTEGER,
+            created_utc  TIMESTAMP WITH TIME ZONE,
+            title        TEXT,
+            retrieved_at TIMESTAMP WITH TIME ZONE,
+            score        INTEGER,
+            permalink    TEXT,
+            locked       BOOLEAN,
+            selftext     TEXT,
+            link         TEXT
+        );
+        CREATE TABLE IF NOT EXISTS compact_comment (
+            id           BIGINT PRIMARY KEY,
+            subreddit_id INTEGER,
+            author_id    INTEGER,
+            body         TEXT,
+            created_utc  TIMESTAMP WITH TIME ZONE,
+            parent_id    TEXT,
+            permalink    TEXT,
+            score        INTEGER,
+            retrieved_at TIMESTAMP WITH TIME ZONE
+        );
+        CREATE OR REPLACE FUNCTION to_base36(number BIGINT) RETURNS TEXT
+        LANGUAGE SQL IMMUTABLE AS $$
+            WITH RECURSIVE
+            alphabet(letters) AS (
+                SELECT '0123456789abcdefghijklmnopqrstuvwxyz'
+            ),
+            digits(rest, encoded) AS (
+                SELECT number / 36, substr(letters, (number % 36)::int + 1, 1)
+                FROM alphabet
+                UNION ALL
+                SELECT rest / 36, substr(letters, (rest % 36)::int + 1, 1) || encoded
+                FROM digits, alphabet WHERE rest > 0
+            )
+            SELECT encoded FROM digits WHERE rest = 0
+        $$;
+        CREATE OR REPLACE VIEW compact_submission_view AS
+        SELECT
+            to_base36(s.id) AS id,
+            r.name AS subreddit,
+            a.name AS author,
+            s.created_utc,
+            s.title,
+            s.retrieved_at,
+            s.score,
+            CASE WHEN s.permalink LIKE '/%' THEN s.permalink
+                ELSE '/r/' || r.name || '/comments/' || s.permalink
+            END AS permalink,
+            s.locked,
+            s.selftext,
+            s.link
+        FROM compact_submission AS s
+            JOIN subreddit AS r ON r.id = s.subreddit_id
+            JOIN author AS a ON a.id = s.author_id;
+        CREATE OR REPLACE VIEW compact_comment_view AS
+        SELECT
+            to_base36(c.id) AS id,
+            r.name AS subreddit,
+            a.name AS author,
+            c.body,
+            c.created_utc,
+            c.parent_id,
+            CASE WHEN c.permalink LIKE '/%' THEN c.permalink
+                ELSE '/r/' || r.name || '/comments/' || c.permalink
+            END AS permalink,
+            c.score,
+            c.retrieved_at
+        FROM compact_comment AS c
+            JOIN subreddit AS r ON r.id = c.subreddit_id
+            JOIN author AS a ON a.id = c.author_id;
+     """
+
+
+def lookup_statement(table: str, names: str) -> str:
+    """
+    Add the `names`, an array, missing from a lookup table and return the
+    id of all of them.
+    The names are inserted in order, so concurrent ingests lock them in the
+    same order. The ones added at the same time by another transaction are
+    missing from the result, they are found once it commits
+    """
+    return f"""
+        WITH added AS (
+            INSERT INTO {table} (name) SELECT unnest({names}) ORDER BY 1
+            ON CONFLICT (name) DO NOTHING
+            RETURNING name, id
+        )
+        SELECT name, id FROM added
+        UNION ALL
+        SELECT name, id FROM {table} WHERE name = ANY({names})
+     """
+
+
+def retrieved_at_statement(table: str, ids: str) -> str:
+    """The id and retrieval time in seconds of the rows with the `ids`, an array"""
+    return (
+        f"SELECT id, extract(epoch FROM retrieved_at) FROM {table}"
+        f" WHERE id = ANY({ids})"
+    )
+
+
+# the server side timings of the statements writing the data, when the
+# pg_stat_statements extension is installed
+HAS_STAT_STATEMENTS = "SELECT to_regclass('pg_stat_statements') IS NOT NULL"
+SERVER_TIMINGS = r"""
+        SELECT query, calls, total_exec_time / 1000, rows
+        FROM pg_stat_statements
+        WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            AND query ~* '^\s*(INSERT|COPY|DELETE|TRUNCATE)'
+     """
+
+
+def submission_row(s: Submission) -> tuple:
+    return (
+        s.id,
+        s.subreddit,
+        s.author,
+        datetime.fromtimestamp(s.created_utc),
+        s.title,
+        datetime.fromtimestamp(s.retrieved_at),
+        s.score,
+        s.permalink,
+        s.locked,
+        s.selftext,
+        s.link,
+    )
+
+
+def comment_row(c: Comment) -> tuple:
+    return (
+        c.id,
+        c.subreddit,
+        c.author,
+        c.body,
+        datetime.fromtimestamp(c.created_utc),
+        c.parent_id,
+        c.permalink,
+        c.score,
+        datetime.fromtimestamp(c.retrieved_at),
+    )
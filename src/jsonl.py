@@ -0,0 +1,74 @@
+import gzip
+import io
+import json
+import os
+
+import zstandard
+
+try:
+    # several times faster than json, when installed
+    import orjson
+except ImportError:
+    orjson = None
+
+# plain, gzip and zstd compressed, as written by the downloader
+JSONL_EXTENSIONS = (".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+
+def without_surrogates(value: str) -> str:
+    """Replace the lone surrogates, that can't be encoded as UTF-8"""
+    return value.encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+
+
+def json_line(record: dict) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            # orjson refuses the lone surrogates of some Reddit texts,
+            # json escapes them
+            pass
+    return (json.dumps(record) + "\n").encode()
+
+
+def json_lines(records: list[dict]) -> bytes:
+    """The records as JSON lines, in a single buffer to be written at once"""
+    return b"".join(json_line(record) for record in records)
+
+
+def json_loads(line: bytes, replace_surrogates: bool = False) -> dict:
+    """
+    Parse a JSON line. The lone surrogates escaped by json are refused by
+    orjson, json parses them and with `replace_surrogates` they are replaced,
+    neither the DB nor Parquet store them
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass
+    record = json.loads(line)
+    if not replace_surrogates:
+        return record
+    return {
+        key: without_surrogates(value) if isinstance(value, str) else value
+        for key, value in record.items()
+    }
+
+
+def open_jsonl(path):
+    """
+    Open a JSONL file for reading, decompressing it on the fly.
+    The lines are bytes, decoded directly by the JSON parser
+    """
+    name = os.fspath(path)
+    if name.endswith(".jsonl.gz"):
+        return gzip.open(path, "rb")
+    if name.endswith(".jsonl.zst"):
+        # the downloader writes a frame at every flush, read them all
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(
+                open(path, "rb"), read_across_frames=True
+            )
+        )
+    return open(path, "rb")
@@ -1,26 +1,45 @@
 import sys
+import gzip
 import json
+import os
+import random
+import sqlite3
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from os.path import join
 from pathlib import Path
+from queue import Empty, Full, Queue
 from datetime import datetime
-from time import time
-from typing import Optional, Tuple
+from enum import Enum
+from time import monotonic, sleep, time
+from typing import List, NamedTuple, Optional, Tuple
 
 import typer
+import yaml
 from typer import Argument
 from typer import Option
 from loguru import logger
 from codetiming import Timer
 from pushshift_py import PushshiftAPI
 import praw
+import requests
+import zstandard
+from prawcore import Requestor
 from prawcore.exceptions import NotFound
 
+from src.jsonl import JSONL_EXTENSIONS, json_lines, json_loads, open_jsonl
+
 
 class HelpMessages:
     help_reddit_url = "https://github.com/reddit-archive/reddit/wiki/OAuth2"
     help_reddit_agent_url = "https://github.com/reddit-archive/reddit/wiki/API"
 
-    subreddit = "The subreddit name"
+    subreddits = "The subreddit names"
+    subreddits_file = "YAML file listing the subreddits, each one a name or a mapping with `subreddit` and optionally `utc_after` or `utc_before`"
     output_dir = "Optional output directory"
     batch_size = "Request `batch_size` submission per time"
     laps = "How many times request `batch_size` reddit submissions"
@@ -30,19 +49,289 @@ class HelpMessages:
     utc_after = "Fetch the submissions after this UTC date"
     utc_before = "Fetch the submissions before this UTC date"
     debug = "Enable debug logging"
+    workers = "How many submissions fetch the comments of at the same time, shared by all the subreddits"
+    requests_per_minute = "Reddit API requests per minute, shared by all the workers"
+    streaming = "Write every submission and its comments as soon as they are fetched, instead of at the end of the lap"
+    resume = "Continue the latest run of the subreddit from its last checkpoint, use the same parameters of the interrupted run"
+    checkpoint_every = "In streaming mode, store a checkpoint every `checkpoint_every` written submissions, the compressed files are flushed with it"
+    compression = "Compress the JSONL files, can be read by the ingest scripts"
+    refresh_after = "Skip the submissions downloaded by a previous run less than `refresh_after` seconds ago, the first time indexes the previous runs"
+
+
+def submission_to_dict(sub: dict, retrieved_at: int) -> dict:
+    """Extract the fields to store from a Pushshift submission"""
+    try:
+        sd = dict(
+            author=sub["author"],
+            id=sub["id"],
+            created_utc=sub["created_utc"],
+            title=sub["title"],
+            permalink=sub["permalink"],
+            score=sub["score"],
+            retrieved_at=retrieved_at,
+            locked=sub.get("locked", False),
+        )
+        if sub["is_self"]:
+            # sometimes is banned but locked=False :/
+            # https://www.reddit.com/r/redditdev/comments/7hfnew/there_is_currently_no_efficient_way_to_tell_if_a/
+            sd["selftext"] = sub.get("selftext", "")
+        else:
+            sd["link"] = sub["url"]
+    except KeyError:
+        logger.warning(f"Offending submission entry: {sub}")
+        raise
+    return sd
+
+
+def comment_to_dict(c, retrieved_at: int) -> dict:
+    """Extract the fields to store from a PRAW comment"""
+    try:
+        cd = dict(
+            id=c.id,
+            body=c.body,
+            created_utc=int(c.created_utc),
+            parent_id=c.parent_id,
+            permalink=c.permalink,
+            score=c.score,
+            retrieved_at=retrieved_at,
+        )
+        if c.author is not None:
+            cd["author"] = c.author.name
+        else:
+            cd["author"] = "[deleted]"
+    except AttributeError:
+        logger.warning(f"Offending comment entry: {str(c)}")
+        raise
+    return cd
+
+
+def comment_submission_id(comment: dict) -> str:
+    # /r/<subreddit>/comments/<submission id>/<title>/<id>/
+    return comment["permalink"].split("/")[4]
+
+
+class Compression(str, Enum):
+    none = "none"
+    gzip = "gzip"
+    zstd = "zstd"
+
+    @property
+    def extension(self) -> str:
+        return {"none": ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}[self.value]
+
+
+def open_jsonl_writer(path: str, compression: Compression, buffer_size: int):
+    """Binary file appending to `path`, compressed according to its extension"""
+    if compression == Compression.gzip:
+        return gzip.open(path, "ab")
+    if compression == Compression.zstd:
+        return zstandard.ZstdCompressor().stream_writer(
+            open(path, "ab", buffering=buffer_size)
+        )
+    return open(path, "ab", buffering=buffer_size)
+
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# the longest frame header, magic number included
+ZSTD_MAX_HEADER_SIZE = 18
+
+
+def zstd_frames_size(f, size: int) -> int:
+    """
+    The size of the complete zstd frames at the start of the file, found
+    walking the headers of the frames and of their blocks
+    """
+    complete = 0
+    while complete < size:
+        f.seek(complete)
+        header = f.read(ZSTD_MAX_HEADER_SIZE)
+        if not header.startswith(ZSTD_MAGIC):
+            return complete
+        try:
+            offset = complete + zstandard.frame_header_size(header)
+            has_checksum = zstandard.get_frame_parameters(header).has_checksum
+        except zstandard.ZstdError:
+            return complete
+        last_block = False
+        while not last_block:
+            f.seek(offset)
+            block_header = f.read(3)
+            if len(block_header) < 3:
+                return complete
+            value = int.from_bytes(block_header, "little")
+            last_block, block_type, block_size = value & 1, (value >> 1) & 3, value >> 3
+            if block_type == 3:
+                # reserved, not written by zstd
+                return complete
+            # an RLE block is a single byte, repeated `block_size` times
+            offset += 3 + (1 if block_type == 1 else block_size)
+        if has_checksum:
+            offset += 4
+        if offset > size:
+            return complete
+        complete = offset
+    return complete
+
+
+def complete_size(path: str, compression: Compression) -> int:
+    """
+    The size of the complete lines, zstd frames or gzip members at the start
+    of the file. A crash while writing can leave a torn one at the end
+    """
+    complete = offset = 0
+    with open(path, "rb") as f:
+        if compression == Compression.none:
+            while block := f.read(LapWriter.buffer_size):
+                newline = block.rfind(b"\n")
+                if newline >= 0:
+                    complete = offset + newline + 1
+                offset += len(block)
+            return complete
+        if compression == Compression.zstd:
+            return zstd_frames_size(f, os.fstat(f.fileno()).st_size)
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        while block := f.read(LapWriter.buffer_size):
+            while block:
+                try:
+                    decompressor.decompress(block)
+                except zlib.error:
+                    return complete
+                if not decompressor.eof:
+                    offset += len(block)
+                    break
+                # a member ended, the next one starts in the same block
+                unused = decompressor.unused_data
+                offset += len(block) - len(unused)
+                complete = offset
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                block = unused
+    return complete
+
+
+def drop_torn_tail(path: str, compression: Compression):
+    """Truncate what a crash left incomplete, before appending to the file"""
+    size = complete_size(path, compression)
+    if size < os.path.getsize(path):
+        logger.warning(f"Dropping the incomplete data at the end of {path}")
+        os.truncate(path, size)
+
+
+def filter_jsonl(path: str, compression: Compression, keep) -> int:
+    """Rewrite the file with only the lines `keep` accepts, return the dropped"""
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        # left by a crash while filtering, the writer appends
+        os.remove(tmp_path)
+    dropped = 0
+    with open_jsonl(path) as fr:
+        fw = open_jsonl_writer(tmp_path, compression, LapWriter.buffer_size)
+        try:
+            for line in fr:
+                if keep(line):
+                    fw.write(line)
+                else:
+                    dropped += 1
+        finally:
+            fw.close()
+    os.replace(tmp_path, path)
+    return dropped
+
+
+class LapWriter:
+    """
+    Append the submissions and comments of a lap to its JSONL files
+    """
+
+    buffer_size = 1024 * 1024
+
+    def __init__(
+        self,
+        submissions_path: str,
+        comments_path: str,
+        compression: Compression = Compression.none,
+    ):
+        self.submissions_path = submissions_path
+        self.comments_path = comments_path
+        self.compression = compression
+        for path in (submissions_path, comments_path):
+            if os.path.isfile(path):
+                drop_torn_tail(path, compression)
+        self.open()
+
+    def open(self):
+        self.submissions_file = open_jsonl_writer(
+            self.submissions_path, self.compression, LapWriter.buffer_size
+        )
+        self.comments_file = open_jsonl_writer(
+            self.comments_path, self.compression, LapWriter.buffer_size
+        )
+
+    def write(self, submissions: list[dict], comments: list[dict]):
+        # the comments are written and flushed before their submissions, a
+        # submission on disk after a crash has all of its comments there
+        if comments:
+            self.comments_file.write(json_lines(comments))
+        if submissions:
+            self.submissions_file.write(json_lines(submissions))
+
+    def flush(self):
+        if self.compression == Compression.zstd:
+            # end the frame, so what is on disk can be decompressed after a crash
+            self.comments_file.flush(zstandard.FLUSH_FRAME)
+            self.submissions_file.flush(zstandard.FLUSH_FRAME)
+        elif self.compression == Compression.gzip:
+            # end the member, a gzip reader fails on an unfinished one
+            self.close()
+            self.open()
+        else:
+            self.comments_file.flush()
+            self.submissions_file.flush()
+
+    def close(self):
+        self.comments_file.close()
+        self.submissions_file.close()
+
+
+@dataclass
+class Checkpoint:
+    """
+    Progress of a run, enough to resume it after a crash.
+    All the laps before `next_lap` are stored, `utc_after` and `utc_before`
+    are the Pushshift cursor after them, and `done_ids` are the submissions
+    of the following laps already written (in streaming mode). The ones
+    written after the checkpoint are recovered from the lap files.
+    """
+
+    next_lap: int = 0
+    utc_after: Optional[int] = None
+    utc_before: Optional[int] = None
+    done_ids: list[str] = field(default_factory=list)
 
 
 class OutputManager:
     """
     Class used to collect and store data (submissions and comments)
+
+    The data is either collected in the lists and stored at the end of the lap
+    with `store`, or streamed to disk as soon as it's available with `append`
     """
 
     params_filename = "params.json"
+    checkpoint_filename = "checkpoint.json"
 
-    def __init__(self, output_dir: str, subreddit: str):
+    def __init__(
+        self,
+        output_dir: str,
+        subreddit: str,
+        run_id: Optional[str] = None,
+        compression: Compression = Compression.none,
+    ):
+        self.subreddit = subreddit
+        self.compression = compression
         self.submissions_list = []
         self.comments_list = []
-        self.run_id = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.lap_writers: dict[int, LapWriter] = {}
+        self.run_id = run_id or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         self.subreddit_dir = join(output_dir, subreddit)
         self.runtime_dir = join(self.subreddit_dir, self.run_id)
@@ -50,6 +339,7 @@ class OutputManager:
         self.submissions_output = join(self.runtime_dir, "submissions")
         self.comments_output = join(self.runtime_dir, "comments")
         self.params_path = join(self.runtime_dir, OutputManager.params_filename)
+        self.checkpoint_path = join(self.runtime_dir, OutputManager.checkpoint_filename)
 
         self.total_submissions_counter = 0
         self.total_comments_counter = 0
@@ -64,56 +354,82 @@ class OutputManager:
         self.submissions_list = []
         self.comments_list = []
 
+    def lap_paths(self, lap: int) -> Tuple[str, str]:
+        return (
+            join(self.submissions_output, f"{lap}{self.compression.extension}"),
+            join(self.comments_output, f"{lap}{self.compression.extension}"),
+        )
+
+    def open_lap(self, lap: int):
+        self.lap_writers[lap] = LapWriter(*self.lap_paths(lap), self.compression)
+
+    def recover_lap(self, lap: int) -> list[tuple]:
+        """
+        The (id, retrieved_at, comments_count) of the submissions a crashed run
+        wrote in the files of an unfinished lap, not to fetch them again.
+        The comments written without their submission are dropped
+        """
+        submissions_path, comments_path = self.lap_paths(lap)
+        entries: dict[str, list] = {}
+        if os.path.isfile(submissions_path):
+            drop_torn_tail(submissions_path, self.compression)
+            with open_jsonl(submissions_path) as fr:
+                for line in fr:
+                    sd = json_loads(line)
+                    entries[sd["id"]] = [sd["id"], sd["retrieved_at"], 0]
+        if os.path.isfile(comments_path):
+            drop_torn_tail(comments_path, self.compression)
+            orphans = 0
+            with open_jsonl(comments_path) as fr:
+                for line in fr:
+                    submission_id = comment_submission_id(json_loads(line))
+                    if submission_id in entries:
+                        entries[submission_id][2] += 1
+                    else:
+                        orphans += 1
+            if orphans:
+                logger.warning(
+                    f"Dropping {orphans} comments of {comments_path} "
+                    f"written without their submission"
+                )
+                filter_jsonl(
+                    comments_path,
+                    self.compression,
+                    lambda line: comment_submission_id(json_loads(line)) in entries,
+                )
+        return [tuple(entry) for entry in entries.values()]
+
+    def append(self, lap: int, submission: dict, comments: list[dict]):
+        if lap not in self.lap_writers:
+            self.open_lap(lap)
+        # Track total data statistics
+        self.total_submissions_counter += 1
+        self.total_comments_counter += len(comments)
+        writer = self.lap_writers[lap]
+        writer.write([submission], comments)
+        if self.compression == Compression.none:
+            # what is in the files is not lost if the process crashes mid-lap,
+            # the compressed files are flushed at the checkpoints instead, not
+            # to end a frame or a member at every submission
+            writer.flush()
+
+    def flush(self):
+        """Make all that was appended readable after a crash"""
+        for writer in self.lap_writers.values():
+            writer.flush()
+
+    def close_lap(self, lap: int):
+        if lap not in self.lap_writers:
+            self.open_lap(lap)
+        self.lap_writers.pop(lap).close()
+
     def store(self, lap: int):
-        now_ts = int(time())
         # Track total data statistics
         self.total_submissions_counter += len(self.submissions_list)
         self.total_comments_counter += len(self.comments_list)
-        with open(join(self.submissions_output, f"{lap}.jsonl"), "a") as f:
-            for sub in self.submissions_list:
-                try:
-                    sd = dict(
-                        author=sub["author"],
-                        id=sub["id"],
-                        created_utc=sub["created_utc"],
-                        title=sub["title"],
-                        permalink=sub["permalink"],
-                        score=sub["score"],
-                        retrieved_at=now_ts,
-                        locked=sub.get("locked", False),
-                    )
-                    if sub["is_self"]:
-                        # sometimes is banned but locked=False :/
-                        # https://www.reddit.com/r/redditdev/comments/7hfnew/there_is_currently_no_efficient_way_to_tell_if_a/
-                        sd["selftext"] = sub.get("selftext", "")
-                    else:
-                        sd["link"] = sub["url"]
-                except KeyError:
-                    logger.warning(f"Offending submission entry: {sub}")
-                    raise
-                f.write(json.dumps(sd))
-                f.write("\n")
-        with open(join(self.comments_output, f"{lap}.jsonl"), "a") as f:
-            for c in self.comments_list:
-                try:
-                    cd = dict(
-                        id=c.id,
-                        body=c.body,
-                        created_utc=int(c.created_utc),
-                        parent_id=c.parent_id,
-                        permalink=c.permalink,
-                        score=c.score,
-                        retrieved_at=now_ts,
-                    )
-                    if c.author is not None:
-                        cd["author"] = c.author.name
-                    else:
-                        cd["author"] = "[deleted]"
-                except AttributeError:
-                    logger.warning(f"Offending comment entry: {str(c)}")
-                    raise
-                f.write(json.dumps(cd))
-                f.write("\n")
+        self.open_lap(lap)
+        self.lap_writers[lap].write(self.submissions_list, self.comments_list)
+        self.close_lap(lap)
 
     def store_params(self, params: dict):
         with open(self.params_path, "w") as f:
@@ -130,19 +446,392 @@ class OutputManager:
         params["utc_newer"] = utc_newer
         self.store_params(params)
 
+    def store_checkpoint(self, checkpoint: Checkpoint):
+        # write aside and rename, a crash must not leave a truncated checkpoint
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(checkpoint), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def load_checkpoint(self) -> Checkpoint:
+        with open(self.checkpoint_path, "r") as f:
+            return Checkpoint(**json.load(f))
+
+    @staticmethod
+    def latest_run_id(output_dir: str, subreddit: str) -> Optional[str]:
+        """The most recent run of the subreddit having a checkpoint, if any"""
+        subreddit_dir = join(output_dir, subreddit)
+        if not os.path.isdir(subreddit_dir):
+            return None
+        run_ids = [
+            run_id
+            for run_id in os.listdir(subreddit_dir)
+            if os.path.isfile(
+                join(subreddit_dir, run_id, OutputManager.checkpoint_filename)
+            )
+        ]
+        # the run ids are timestamps, the lexicographic order is the temporal one
+        return max(run_ids, default=None)
+
+
+class SubmissionIndex:
+    """
+    Persistent index of the submissions downloaded by all the runs of a
+    subreddit, to avoid fetching again the comments of recent ones.
+    Shared by the pipeline threads.
+    """
+
+    filename = "index.sqlite"
+
+    @staticmethod
+    def exists(subreddit_dir: str) -> bool:
+        return os.path.isfile(join(subreddit_dir, SubmissionIndex.filename))
+
+    def __init__(self, subreddit_dir: str):
+        path = join(subreddit_dir, SubmissionIndex.filename)
+        is_new = not os.path.isfile(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS submission_index (
+                id             TEXT PRIMARY KEY,
+                retrieved_at   INTEGER,
+                comments_count INTEGER
+            )
+            """)
+        if is_new:
+            self.rebuild(subreddit_dir)
+
+    def rebuild(self, subreddit_dir: str):
+        """
+        Index the runs downloaded before the index existed. The comments are
+        counted in the run of the latest retrieval of their submission, as
+        the pipeline does
+        """
+        entries: dict[str, list] = {}
+        latest_run: dict[str, str] = {}
+        for root, _dirs, files in os.walk(subreddit_dir):
+            if not root.endswith("submissions"):
+                continue
+            for fname in files:
+                if not fname.endswith(JSONL_EXTENSIONS):
+                    continue
+                with open_jsonl(join(root, fname)) as fr:
+                    for line in fr:
+                        sd = json_loads(line)
+                        if (
+                            sd["id"] not in entries
+                            or entries[sd["id"]][1] < sd["retrieved_at"]
+                        ):
+                            entries[sd["id"]] = [sd["id"], sd["retrieved_at"], 0]
+                            latest_run[sd["id"]] = os.path.dirname(root)
+        for root, _dirs, files in os.walk(subreddit_dir):
+            if not root.endswith("comments"):
+                continue
+            run_dir = os.path.dirname(root)
+            for fname in files:
+                if not fname.endswith(JSONL_EXTENSIONS):
+                    continue
+                with open_jsonl(join(root, fname)) as fr:
+                    for line in fr:
+                        submission_id = comment_submission_id(json_loads(line))
+                        if latest_run.get(submission_id) == run_dir:
+                            entries[submission_id][2] += 1
+        self.record(entries.values())
+        logger.info(f"Indexed {len(entries)} submissions of the previous runs")
+
+    def is_fresh(self, submission_id: str, max_age: int) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT retrieved_at FROM submission_index WHERE id = ?",
+                (submission_id,),
+            ).fetchone()
+        return row is not None and time() - row[0] < max_age
+
+    def record(self, entries):
+        """Store (id, retrieved_at, comments_count) entries"""
+        with self._lock:
+            self._conn.executemany(
+                """
+                INSERT INTO submission_index (id, retrieved_at, comments_count)
+                VALUES (?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    retrieved_at = excluded.retrieved_at,
+                    comments_count = excluded.comments_count
+                WHERE excluded.retrieved_at >= submission_index.retrieved_at
+                """,
+                entries,
+            )
+            self._conn.commit()
+
+
+@dataclass
+class RequestStats:
+    requests: int = 0
+    retries: int = 0
+    waiting: float = 0.0
+    transferring: float = 0.0
+
+    def add(self, other: "RequestStats"):
+        self.requests += other.requests
+        self.retries += other.retries
+        self.waiting += other.waiting
+        self.transferring += other.transferring
+
+    def __str__(self):
+        return (
+            f"{self.requests} requests, {self.retries} retries, "
+            f"waiting {self.waiting:.1f}s, transferring {self.transferring:.1f}s"
+        )
+
+
+class RequestScheduler:
+    """
+    Schedule the requests to an API made by many threads:
+    - spread them to stay within a budget of requests per minute, slowing
+      down when the rate limit headers say the remaining budget is running out
+    - retry the ones failing with 429 or 5xx, with a jittered exponential backoff
+    - account the time spent waiting and transferring, grouped by the tag
+      of the calling thread
+    """
+
+    max_retries = 5
+    base_backoff = 1.0
+    max_backoff = 120.0
+
+    def __init__(self, requests_per_minute: int):
+        self.min_interval = 60 / requests_per_minute
+        self.interval = self.min_interval
+        self.total = RequestStats()
+        self._next_slot = monotonic()
+        self._stats: dict = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def tagged(self, tag):
+        """Account the requests made in the block to the given tag"""
+        previous = getattr(self._local, "tag", None)
+        self._local.tag = tag
+        try:
+            yield
+        finally:
+            self._local.tag = previous
+
+    def pop_stats(self, tag) -> RequestStats:
+        with self._lock:
+            return self._stats.pop(tag, RequestStats())
+
+    def _account(self, stats: RequestStats):
+        tag = getattr(self._local, "tag", None)
+        with self._lock:
+            self.total.add(stats)
+            if tag is not None:
+                self._stats.setdefault(tag, RequestStats()).add(stats)
+
+    def _wait_turn(self) -> float:
+        with self._lock:
+            now = monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            sleep(wait)
+            return wait
+        return 0.0
+
+    def _update(self, headers):
+        # the Reddit ones, Pushshift doesn't send any
+        if "x-ratelimit-remaining" not in headers or "x-ratelimit-reset" not in headers:
+            return
+        remaining = float(headers["x-ratelimit-remaining"])
+        seconds_to_reset = float(headers["x-ratelimit-reset"])
+        with self._lock:
+            if remaining < 1:
+                self._next_slot = max(self._next_slot, monotonic() + seconds_to_reset)
+            # spread what is left until the reset, never faster than the budget
+            self.interval = max(self.min_interval, seconds_to_reset / max(remaining, 1))
+
+    def _backoff(self, attempt: int, headers) -> float:
+        retry_after = headers.get("retry-after", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+        backoff = min(self.max_backoff, self.base_backoff * 2**attempt)
+        return backoff * random.uniform(0.5, 1.5)
+
+    def request(self, request_function, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            stats = RequestStats(requests=1, waiting=self._wait_turn())
+            start = monotonic()
+            response = request_function(*args, **kwargs)
+            stats.transferring = monotonic() - start
+            self._update(response.headers)
+            if (
+                response.status_code != 429 and response.status_code < 500
+            ) or attempt == self.max_retries:
+                self._account(stats)
+                return response
+            backoff = self._backoff(attempt, response.headers)
+            logger.debug(f"Got HTTP {response.status_code}, retrying in {backoff:.1f}s")
+            stats.retries = 1
+            stats.waiting += backoff
+            self._account(stats)
+            sleep(backoff)
+
+
+class ScheduledRequestor(Requestor):
+    """
+    prawcore requestor sending every HTTP call through the shared scheduler
+    """
+
+    def __init__(self, *args, scheduler: RequestScheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def request(self, *args, **kwargs):
+        return self.scheduler.request(super().request, *args, **kwargs)
+
+
+class RedditClientPool:
+    """
+    Give each thread its own PRAW client, since they are not thread safe.
+    All the clients share the same request scheduler
+    """
+
+    def __init__(
+        self,
+        reddit_id: str,
+        reddit_secret: str,
+        reddit_username: str,
+        requests_per_minute: int,
+    ):
+        self.reddit_id = reddit_id
+        self.reddit_secret = reddit_secret
+        self.user_agent = (
+            f"python_script:subreddit_downloader:(by /u/{reddit_username})"
+        )
+        self.scheduler = RequestScheduler(requests_per_minute)
+        self._local = threading.local()
+
+    def get(self) -> praw.Reddit:
+        if not hasattr(self._local, "reddit_api"):
+            self._local.reddit_api = praw.Reddit(
+                client_id=self.reddit_id,
+                client_secret=self.reddit_secret,
+                user_agent=self.user_agent,
+                requestor_class=ScheduledRequestor,
+                requestor_kwargs={"scheduler": self.scheduler},
+            )
+        return self._local.reddit_api
+
+
+class ScheduledPushshiftAPI(PushshiftAPI):
+    """
+    Pushshift client sending every HTTP call through the shared scheduler,
+    which takes care of the retries
+    """
+
+    def __init__(self, *args, scheduler: Optional[RequestScheduler] = None, **kwargs):
+        self.scheduler = scheduler
+        super().__init__(*args, **kwargs)
+
+    def _get(self, url, payload=None):
+        # the constructor asks for the server rate limit before the scheduler exists
+        if self.scheduler is None:
+            return super()._get(url, payload)
+        response = self.scheduler.request(requests.get, url, params=payload or {})
+        response.raise_for_status()
+        return json.loads(response.text)
+
+
+class PushshiftClientPool:
+    """
+    Give each subreddit its own Pushshift client, since they keep the paging
+    state of the running search.
+    All the clients share the same request scheduler, sized on the limit
+    declared by the server
+    """
+
+    def __init__(self):
+        first_client = ScheduledPushshiftAPI()
+        self.requests_per_minute = first_client._rlcache.max_storage
+        self.scheduler = RequestScheduler(self.requests_per_minute)
+        first_client.scheduler = self.scheduler
+        self._unused = [first_client]
+
+    def get(self) -> ScheduledPushshiftAPI:
+        if self._unused:
+            return self._unused.pop()
+        return ScheduledPushshiftAPI(
+            rate_limit_per_minute=self.requests_per_minute,
+            scheduler=self.scheduler,
+        )
+
 
 def init_clients(
-    reddit_id: str, reddit_secret: str, reddit_username: str
-) -> Tuple[PushshiftAPI, praw.Reddit]:
-    pushshift_api = PushshiftAPI()
-
-    reddit_api = praw.Reddit(
-        client_id=reddit_id,
-        client_secret=reddit_secret,
-        user_agent=f"python_script:subreddit_downloader:(by /u/{reddit_username})",
+    reddit_id: str, reddit_secret: str, reddit_username: str, requests_per_minute: int
+) -> Tuple[PushshiftClientPool, RedditClientPool]:
+    pushshift_clients = PushshiftClientPool()
+
+    reddit_clients = RedditClientPool(
+        reddit_id, reddit_secret, reddit_username, requests_per_minute
     )
 
-    return pushshift_api, reddit_api
+    return pushshift_clients, reddit_clients
+
+
+class SubredditSpec(NamedTuple):
+    subreddit: str
+    utc_after: Optional[int]
+    utc_before: Optional[int]
+
+
+def load_subreddits(
+    subreddits: Optional[List[str]],
+    subreddits_file: Optional[str],
+    utc_after: Optional[int],
+    utc_before: Optional[int],
+) -> list[SubredditSpec]:
+    """
+    Collect the subreddits from the arguments and the YAML file.
+    The subreddits in the file can have their own time window, otherwise they
+    use the one of the arguments
+    """
+    specs = [SubredditSpec(s, utc_after, utc_before) for s in subreddits or []]
+    if subreddits_file is not None:
+        with open(subreddits_file) as f:
+            for entry in yaml.safe_load(f):
+                if isinstance(entry, str):
+                    specs.append(SubredditSpec(entry, utc_after, utc_before))
+                elif "utc_after" in entry or "utc_before" in entry:
+                    specs.append(
+                        SubredditSpec(
+                            entry["subreddit"],
+                            entry.get("utc_after"),
+                            entry.get("utc_before"),
+                        )
+                    )
+                else:
+                    specs.append(
+                        SubredditSpec(entry["subreddit"], utc_after, utc_before)
+                    )
+    assert specs, "No subreddit to download, pass them as arguments or in a file"
+    names = [spec.subreddit for spec in specs]
+    assert len(set(names)) == len(names), "Every subreddit can be listed only once"
+    return specs
+
+
+# taken from the params.json of the interrupted run when resuming
+RESUMED_PARAMS = (
+    "batch_size",
+    "laps",
+    "utc_after",
+    "utc_before",
+    "streaming",
+    "compression",
+)
 
 
 def init_locals(
@@ -151,41 +840,67 @@ def init_locals(
     subreddit: str,
     utc_after: Optional[int],
     utc_before: Optional[int],
+    resume: bool,
+    compression: Compression,
     run_args: dict,
-) -> Tuple[str, OutputManager]:
+) -> Tuple[str, OutputManager, Checkpoint, dict]:
+    """
+    The direction, output manager, checkpoint and parameters of the run.
+    A resumed run keeps the parameters stored in its params.json, the ones
+    that shape the output can't change halfway
+    """
     assert not (
         utc_after and utc_before
     ), "`utc_before` and `utc_after` parameters are in mutual exclusion"
     run_args.pop("reddit_secret")
+    run_args.pop("subreddits")
+    run_args.pop("subreddits_file")
+    assert run_args["workers"] > 0, "`workers` must be at least 1"
 
     if not debug:
         logger.remove()
         logger.add(sys.stderr, level="INFO")
 
-    direction = "after" if utc_after else "before"
-    output_manager = OutputManager(output_dir, subreddit)
-
-    output_manager.store_params(run_args)
-    return direction, output_manager
+    if resume:
+        run_id = OutputManager.latest_run_id(output_dir, subreddit)
+        assert run_id is not None, f"No run of `{subreddit}` to resume"
+        output_manager = OutputManager(output_dir, subreddit, run_id)
+        stored_args = output_manager.load_params()
+        # the runs before the compression option are not compressed
+        stored_args.setdefault("compression", Compression.none.value)
+        for name in RESUMED_PARAMS:
+            value = stored_args[name]
+            if value != run_args[name]:
+                logger.info(f"Resuming with the {name} of the run: {value}")
+            run_args[name] = value
+        output_manager.compression = Compression(run_args["compression"])
+        checkpoint = output_manager.load_checkpoint()
+        logger.info(f"Resuming run `{run_id}` from lap {checkpoint.next_lap}")
+    else:
+        output_manager = OutputManager(output_dir, subreddit, compression=compression)
+        output_manager.store_params(run_args)
+        checkpoint = Checkpoint(utc_after=utc_after, utc_before=utc_before)
+        output_manager.store_checkpoint(checkpoint)
+    direction = "after" if run_args["utc_after"] else "before"
+    return direction, output_manager, checkpoint, run_args
 
 
-def comments_fetcher(sub, output_manager, reddit_api):
+def comments_fetcher(sub, reddit_clients: RedditClientPool) -> list:
     """
     Comments fetcher
     Get all comments with depth-first approach
     Solution from https://praw.readthedocs.io/en/latest/tutorials/comments.html
+    Can be called from multiple threads at once
     """
     try:
-        submission_rich_data = reddit_api.submission(id=sub.id)
+        submission_rich_data = reddit_clients.get().submission(id=sub.id)
         submission_rich_data.comments.replace_more(limit=None)
-        comments = submission_rich_data.comments.list()
+        return submission_rich_data.comments.list()
     except NotFound:  # Submission found on pushshift but not in praw
         logger.warning(
             f"Submission not found in PRAW: `{sub.id}` - `{sub.title}` - `{sub.full_link}`"
         )
-        return
-    for comment in comments:
-        output_manager.comments_list.append(comment)
+        return []
 
 
 def utc_range_calculator(
@@ -205,78 +920,560 @@ def utc_range_calculator(
     return utc_after, utc_before
 
 
-@Timer(name="main", text="Total downloading time: {minutes:.1f}m", logger=logger.info)
-def main(
-    subreddit: str = Argument(..., help=HelpMessages.subreddit),
-    output_dir: str = Option("./data/", help=HelpMessages.output_dir),
-    batch_size: int = Option(10, help=HelpMessages.batch_size),
-    laps: int = Option(3, help=HelpMessages.laps),
-    reddit_id: str = Option(..., help=HelpMessages.reddit_id),
-    reddit_secret: str = Option(..., help=HelpMessages.reddit_secret),
-    reddit_username: str = Option(..., help=HelpMessages.reddit_username),
-    utc_after: Optional[int] = Option(None, help=HelpMessages.utc_after),
-    utc_before: Optional[int] = Option(None, help=HelpMessages.utc_before),
-    debug: bool = Option(False, help=HelpMessages.debug),
-):
+class LapEnd(NamedTuple):
+    """Sent by the producer after the last submission of a lap"""
+
+    lap: int
+    submissions_count: int
+    started_at: float
+    utc_after: Optional[int]
+    utc_before: Optional[int]
+
+
+class StageFailed(NamedTuple):
+    """Sent to the writer when a stage crashes, to re-raise the error there"""
+
+    error: BaseException
+
+
+class PipelineStopped(Exception):
+    """Raised by the writer stage of a pipeline stopped from outside"""
+
+
+class FairQueue:
     """
-    Download all the submissions and relative comments from a subreddit.
+    Queue with a bounded lane for every key, served round-robin so that a key
+    with many pending items doesn't starve the others
     """
 
-    # Init
-    direction, out_manager = init_locals(
-        debug, output_dir, subreddit, utc_after, utc_before, run_args=locals()
-    )
-    pushshift_api, reddit_api = init_clients(reddit_id, reddit_secret, reddit_username)
-    logger.info(
-        f"Start download: "
-        f"UTC range: [{utc_before}, {utc_after}], "
-        f"direction: `{direction}`, "
-        f"batch size: {batch_size}, "
-        f"total submissions to fetch: {batch_size * laps}"
-    )
+    def __init__(self, lane_size: int):
+        self.lane_size = lane_size
+        self._lanes: dict = {}
+        self._turns: deque = deque()
+        self._closed = False
+        self._discarded: set = set()
+        self._condition = threading.Condition()
+
+    def put(self, key, item):
+        with self._condition:
+            lane = self._lanes.setdefault(key, deque())
+            while len(lane) >= self.lane_size and key not in self._discarded:
+                self._condition.wait()
+            if key in self._discarded:
+                return
+            lane.append(item)
+            if len(lane) == 1:
+                self._turns.append(key)
+            self._condition.notify_all()
+
+    def get(self):
+        """The next item, or None once closed and empty"""
+        with self._condition:
+            while not self._turns:
+                if self._closed:
+                    return None
+                self._condition.wait()
+            key = self._turns.popleft()
+            lane = self._lanes[key]
+            item = lane.popleft()
+            if lane:
+                self._turns.append(key)
+            self._condition.notify_all()
+            return item
+
+    def discard(self, key):
+        """Drop the pending items of the key, and the ones put from now on"""
+        with self._condition:
+            self._discarded.add(key)
+            self._lanes.pop(key, None)
+            if key in self._turns:
+                self._turns.remove(key)
+            self._condition.notify_all()
 
-    # Start the gathering
-    for lap in range(laps):
-        lap_message = f"Lap {lap}/{laps} completed in " "{minutes:.1f}m"
-        with Timer(text=lap_message, logger=logger.info):
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
 
-            # Reset the data already stored
-            out_manager.reset_lists()
 
+class CommentWorkers:
+    """
+    Pool of threads fetching the comment trees for all the download pipelines,
+    taking turns between them
+    """
+
+    def __init__(self, reddit_clients: RedditClientPool, workers: int):
+        self.reddit_clients = reddit_clients
+        self.workers = workers
+        self.queue = FairQueue(lane_size=workers * 2)
+        for _ in range(workers):
+            threading.Thread(target=self.fetch_comments, daemon=True).start()
+
+    def submit(self, pipeline: "DownloadPipeline", lap: int, position: int, sub):
+        self.queue.put(pipeline, (pipeline, lap, position, sub))
+
+    def fetch_comments(self):
+        while (item := self.queue.get()) is not None:
+            pipeline, lap, position, sub = item
+            if pipeline.stopped.is_set():
+                continue
+            try:
+                with self.reddit_clients.scheduler.tagged((pipeline, lap)):
+                    comments = comments_fetcher(sub, self.reddit_clients)
+                # drop the PRAW objects as soon as possible, they are heavy
+                retrieved_at = int(time())
+                pipeline.put_result(
+                    (
+                        lap,
+                        position,
+                        submission_to_dict(sub.d_, retrieved_at),
+                        [comment_to_dict(c, retrieved_at) for c in comments],
+                    )
+                )
+            except BaseException as e:
+                pipeline.put_result(StageFailed(e))
+
+    def discard(self, pipeline: "DownloadPipeline"):
+        self.queue.discard(pipeline)
+
+    def close(self):
+        self.queue.close()
+
+
+class DownloadPipeline:
+    """
+    Overlap the three stages of the download of a subreddit: paging Pushshift,
+    fetching the comment trees (in the shared `CommentWorkers`) and writing
+    to disk.
+    The stages are connected by bounded queues, so the memory usage is capped
+    and the total time approaches the one of the slowest stage.
+    In streaming mode the results are written as they arrive instead of being
+    collected for the whole lap, so the memory usage doesn't grow with the
+    batch size.
+    The writer stage stores a checkpoint after every lap, and in streaming
+    mode also every `checkpoint_every` submissions.
+    When `refresh_after` is given, the submissions in the index downloaded
+    less than `refresh_after` seconds ago are skipped. In streaming mode the
+    written submissions are recorded in the index at every checkpoint.
+    When the writer stops, on error or by `stop`, the other stages drop the
+    items of the pipeline instead of waiting for it.
+    """
+
+    def __init__(
+        self,
+        pushshift_api: ScheduledPushshiftAPI,
+        comment_workers: CommentWorkers,
+        out_manager: OutputManager,
+        streaming: bool = False,
+        checkpoint_every: int = 100,
+        index: Optional[SubmissionIndex] = None,
+        refresh_after: Optional[int] = None,
+    ):
+        self.pushshift_api = pushshift_api
+        self.comment_workers = comment_workers
+        self.out_manager = out_manager
+        self.streaming = streaming
+        self.checkpoint_every = checkpoint_every
+        self.resumed_ids: list[str] = []
+        self.index = index
+        # the written submissions not recorded in the index yet
+        self.index_entries: list[tuple] = []
+        self.refresh_after = refresh_after
+        self.results_queue: Queue = Queue(maxsize=comment_workers.workers * 2)
+        self.utc_after: Optional[int] = None
+        self.utc_before: Optional[int] = None
+        self.stopped = threading.Event()
+
+    def _stage(self, target, *args):
+        try:
+            target(*args)
+        except BaseException as e:
+            self.put_result(StageFailed(e))
+
+    def put_result(self, item):
+        """Send an item to the writer, unless the pipeline was stopped"""
+        while not self.stopped.is_set():
+            try:
+                self.results_queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def next_result(self):
+        while True:
+            try:
+                return self.results_queue.get(timeout=1)
+            except Empty:
+                if self.stopped.is_set():
+                    raise PipelineStopped()
+
+    def stop(self):
+        """Stop all the stages, the writer raises `PipelineStopped` if running"""
+        self.stopped.set()
+        self.comment_workers.discard(self)
+
+    def produce(
+        self,
+        subreddit: str,
+        batch_size: int,
+        laps: int,
+        direction: str,
+        start_lap: int,
+        skip_ids: set[str],
+    ):
+        for lap in range(start_lap, laps):
+            if self.stopped.is_set():
+                return
+            started_at = time()
             # Fetch data in the `direction` way
-            submissions_generator = pushshift_api.search_submissions(
+            submissions_generator = self.pushshift_api.search_submissions(
                 subreddit=subreddit,
                 limit=batch_size,
                 sort="desc",
                 sort_type="created_utc",
-                after=utc_after if direction == "after" else None,
-                before=utc_before if direction == "before" else None,
+                after=self.utc_after if direction == "after" else None,
+                before=self.utc_before if direction == "before" else None,
+            )
+            # the UTC range of the next lap depends on this one, update it aside
+            utc_after, utc_before = self.utc_after, self.utc_before
+            submissions_count = 0
+            # account the Pushshift requests made while paging to this lap
+            with self.pushshift_api.scheduler.tagged((self, lap)):
+                for sub in submissions_generator:
+                    if self.stopped.is_set():
+                        return
+                    # Calculate the UTC seen range
+                    utc_after, utc_before = utc_range_calculator(
+                        sub.created_utc, utc_after, utc_before
+                    )
+                    # already written before resuming
+                    if sub.id in skip_ids:
+                        continue
+                    # downloaded recently by a previous run
+                    if (
+                        self.index is not None
+                        and self.refresh_after is not None
+                        and self.index.is_fresh(sub.id, self.refresh_after)
+                    ):
+                        logger.debug(
+                            f"Skipping recently downloaded submission {sub.id}"
+                        )
+                        continue
+                    self.comment_workers.submit(self, lap, submissions_count, sub)
+                    submissions_count += 1
+            self.utc_after, self.utc_before = utc_after, utc_before
+            self.put_result(
+                LapEnd(lap, submissions_count, started_at, utc_after, utc_before)
             )
+            if utc_after is not None:
+                logger.info(
+                    f"{subreddit} "
+                    f"utc_after: {utc_after} ({datetime.fromtimestamp(utc_after).isoformat()}), "
+                    f"utc_before: {utc_before} ({datetime.fromtimestamp(utc_before).isoformat()})"
+                )
 
-            for sub in submissions_generator:
-                # Fetch the submission data
-                out_manager.submissions_list.append(sub.d_)
+    def store_lap(self, lap: int, lap_results: dict):
+        # Reset the data already stored
+        self.out_manager.reset_lists()
+        # Keep the same order Pushshift returned the submissions in
+        for position in sorted(lap_results):
+            submission, comments = lap_results[position]
+            self.out_manager.submissions_list.append(submission)
+            self.out_manager.comments_list.extend(comments)
+        # Store data (submission and comments)
+        self.out_manager.store(lap)
+        self.out_manager.reset_lists()
+        if self.index is not None:
+            self.index.record(
+                (submission["id"], submission["retrieved_at"], len(comments))
+                for submission, comments in lap_results.values()
+            )
+
+    def run(
+        self,
+        subreddit: str,
+        batch_size: int,
+        laps: int,
+        direction: str,
+        checkpoint: Checkpoint,
+    ) -> Tuple[Optional[int], Optional[int]]:
+        try:
+            return self.write(subreddit, batch_size, laps, direction, checkpoint)
+        finally:
+            # no more results are read, don't let the shared workers wait
+            self.stop()
 
-                # Fetch the submission's comments
-                comments_fetcher(sub, out_manager, reddit_api)
+    def write(
+        self,
+        subreddit: str,
+        batch_size: int,
+        laps: int,
+        direction: str,
+        checkpoint: Checkpoint,
+    ) -> Tuple[Optional[int], Optional[int]]:
+        self.utc_after, self.utc_before = checkpoint.utc_after, checkpoint.utc_before
+        # the submissions written after the last checkpoint are in the files
+        # of the unfinished laps, they are not fetched again
+        recovered = [
+            entry
+            for lap in range(checkpoint.next_lap, laps)
+            for entry in self.out_manager.recover_lap(lap)
+        ]
+        if recovered and self.index is not None:
+            self.index.record(recovered)
+        checkpointed_ids = set(checkpoint.done_ids)
+        checkpoint.done_ids = checkpoint.done_ids + [
+            entry[0] for entry in recovered if entry[0] not in checkpointed_ids
+        ]
+        threading.Thread(
+            target=self._stage,
+            args=(
+                self.produce,
+                subreddit,
+                batch_size,
+                laps,
+                direction,
+                checkpoint.next_lap,
+                set(checkpoint.done_ids),
+            ),
+            daemon=True,
+        ).start()
 
-                # Calculate the UTC seen range
-                utc_after, utc_before = utc_range_calculator(
-                    sub.created_utc, utc_after, utc_before
+        # the writer stage runs in the current thread
+        pending: dict[int, dict] = {}
+        done: dict[int, int] = {}
+        stored_comments: dict[int, int] = {}
+        lap_ends: dict[int, LapEnd] = {}
+        # the ids written so far for the laps after `checkpoint.next_lap`,
+        # the ones written before resuming are kept until the end of the run
+        self.resumed_ids = checkpoint.done_ids
+        done_ids: dict[int, list[str]] = {lap: [] for lap in range(laps)}
+        stored_laps = set()
+        appended_since_checkpoint = 0
+        while checkpoint.next_lap < laps:
+            item = self.next_result()
+            if isinstance(item, StageFailed):
+                raise item.error
+            if isinstance(item, LapEnd):
+                lap_ends[item.lap] = item
+                lap = item.lap
+            else:
+                lap, position, submission, comments = item
+                done[lap] = done.get(lap, 0) + 1
+                stored_comments[lap] = stored_comments.get(lap, 0) + len(comments)
+                if self.streaming:
+                    self.out_manager.append(lap, submission, comments)
+                    if self.index is not None:
+                        self.index_entries.append(
+                            (
+                                submission["id"],
+                                submission["retrieved_at"],
+                                len(comments),
+                            )
+                        )
+                    done_ids[lap].append(submission["id"])
+                    appended_since_checkpoint += 1
+                    if appended_since_checkpoint >= self.checkpoint_every:
+                        self.store_checkpoint(checkpoint, done_ids)
+                        appended_since_checkpoint = 0
+                else:
+                    pending.setdefault(lap, {})[position] = (submission, comments)
+            lap_end = lap_ends.get(lap)
+            if lap_end and done.get(lap, 0) == lap_end.submissions_count:
+                if self.streaming:
+                    self.out_manager.close_lap(lap)
+                else:
+                    lap_results = pending.pop(lap, {})
+                    self.store_lap(lap, lap_results)
+                    # a lap stored before the previous ones is skipped on resume
+                    done_ids[lap] = [s["id"] for s, _ in lap_results.values()]
+                logger.info(
+                    f"{subreddit} stored comments: {stored_comments.pop(lap, 0)}"
+                )
+                logger.info(
+                    f"{subreddit} lap {lap}/{laps} completed in "
+                    f"{(time() - lap_end.started_at) / 60:.1f}m"
                 )
+                self.log_request_stats(subreddit, lap)
+                # laps can complete out of order, the checkpoint advances only
+                # when all the previous ones are stored
+                stored_laps.add(lap)
+                while checkpoint.next_lap in stored_laps:
+                    next_lap_end = lap_ends[checkpoint.next_lap]
+                    checkpoint.utc_after = next_lap_end.utc_after
+                    checkpoint.utc_before = next_lap_end.utc_before
+                    done_ids.pop(checkpoint.next_lap)
+                    checkpoint.next_lap += 1
+                self.store_checkpoint(checkpoint, done_ids)
+                appended_since_checkpoint = 0
+        return self.utc_after, self.utc_before
 
-            # Store data (submission and comments)
-            out_manager.store(lap)
-            logger.info(f"Stored comments: {len(out_manager.comments_list)}")
-        logger.info(
-            f"utc_after: {utc_after} ({datetime.fromtimestamp(utc_after).isoformat()}), "
-            f"utc_before: {utc_before} ({datetime.fromtimestamp(utc_before).isoformat()})"
+    def log_request_stats(self, subreddit: str, lap: int):
+        pushshift_stats = self.pushshift_api.scheduler.pop_stats((self, lap))
+        reddit_stats = self.comment_workers.reddit_clients.scheduler.pop_stats(
+            (self, lap)
         )
-    out_manager.store_utc_params(utc_newer=utc_after, utc_older=utc_before)
+        logger.info(f"{subreddit} lap {lap} Pushshift: {pushshift_stats}")
+        logger.info(f"{subreddit} lap {lap} Reddit: {reddit_stats}")
+
+    def store_checkpoint(self, checkpoint: Checkpoint, done_ids: dict[int, list[str]]):
+        # the files have all the submissions of the checkpoint before it
+        self.out_manager.flush()
+        # in a single transaction, the submissions written since the last one
+        if self.index_entries:
+            self.index.record(self.index_entries)
+            self.index_entries = []
+        checkpoint.done_ids = self.resumed_ids + [
+            i for lap_ids in done_ids.values() for i in lap_ids
+        ]
+        self.out_manager.store_checkpoint(checkpoint)
+
+
+class Download(NamedTuple):
+    subreddit: str
+    batch_size: int
+    laps: int
+    direction: str
+    checkpoint: Checkpoint
+    pipeline: DownloadPipeline
 
-    logger.info(
-        f"Stop download: lap {laps}/{laps} [total]: {out_manager.total_comments_counter}"
+
+def run_downloads(downloads: list[Download]):
+    """
+    Run the pipelines of the subreddits, their writer stages in parallel.
+    When one fails the others are stopped, the first error is raised once
+    all of them are over
+    """
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(downloads)) as executor:
+        futures = [
+            executor.submit(
+                d.pipeline.run,
+                d.subreddit,
+                d.batch_size,
+                d.laps,
+                d.direction,
+                d.checkpoint,
+            )
+            for d in downloads
+        ]
+        wait(futures, return_when=FIRST_EXCEPTION)
+        if any(f.done() and f.exception() is not None for f in futures):
+            # a subreddit failed, stop the others instead of waiting for them
+            for d in downloads:
+                d.pipeline.stop()
+        for d, future in zip(downloads, futures):
+            try:
+                utc_after, utc_before = future.result()
+            except PipelineStopped:
+                logger.warning(f"Stopped download of {d.subreddit}")
+                continue
+            except BaseException as e:
+                logger.error(f"Download of {d.subreddit} failed: {e!r}")
+                errors.append(e)
+                continue
+            out_manager = d.pipeline.out_manager
+            out_manager.store_utc_params(utc_newer=utc_after, utc_older=utc_before)
+            logger.info(
+                f"Stop download of {d.subreddit}: lap {d.laps}/{d.laps} "
+                f"[total]: {out_manager.total_comments_counter}"
+            )
+    if errors:
+        raise errors[0]
+
+
+@Timer(name="main", text="Total downloading time: {minutes:.1f}m", logger=logger.info)
+def main(
+    subreddits: Optional[List[str]] = Argument(None, help=HelpMessages.subreddits),
+    subreddits_file: Optional[str] = Option(None, help=HelpMessages.subreddits_file),
+    output_dir: str = Option("./data/", help=HelpMessages.output_dir),
+    batch_size: int = Option(10, help=HelpMessages.batch_size),
+    laps: int = Option(3, help=HelpMessages.laps),
+    reddit_id: str = Option(..., help=HelpMessages.reddit_id),
+    reddit_secret: str = Option(..., help=HelpMessages.reddit_secret),
+    reddit_username: str = Option(..., help=HelpMessages.reddit_username),
+    utc_after: Optional[int] = Option(None, help=HelpMessages.utc_after),
+    utc_before: Optional[int] = Option(None, help=HelpMessages.utc_before),
+    debug: bool = Option(False, help=HelpMessages.debug),
+    workers: int = Option(8, help=HelpMessages.workers),
+    requests_per_minute: int = Option(60, help=HelpMessages.requests_per_minute),
+    streaming: bool = Option(False, help=HelpMessages.streaming),
+    resume: bool = Option(False, help=HelpMessages.resume),
+    checkpoint_every: int = Option(100, help=HelpMessages.checkpoint_every),
+    refresh_after: Optional[int] = Option(None, help=HelpMessages.refresh_after),
+    compression: Compression = Option(
+        Compression.none.value, help=HelpMessages.compression
+    ),
+):
+    """
+    Download all the submissions and relative comments from one or more subreddits.
+    """
+    run_args = locals()
+
+    # Init
+    specs = load_subreddits(subreddits, subreddits_file, utc_after, utc_before)
+    pushshift_clients, reddit_clients = init_clients(
+        reddit_id, reddit_secret, reddit_username, requests_per_minute
     )
+    comment_workers = CommentWorkers(reddit_clients, workers)
+    downloads = []
+    for spec in specs:
+        direction, out_manager, checkpoint, spec_args = init_locals(
+            debug,
+            output_dir,
+            spec.subreddit,
+            spec.utc_after,
+            spec.utc_before,
+            resume,
+            compression,
+            run_args={
+                **run_args,
+                "subreddit": spec.subreddit,
+                "utc_after": spec.utc_after,
+                "utc_before": spec.utc_before,
+            },
+        )
+        logger.info(
+            f"Start download of {spec.subreddit}: "
+            f"UTC range: [{spec_args['utc_before']}, {spec_args['utc_after']}], "
+            f"direction: `{direction}`, "
+            f"batch size: {spec_args['batch_size']}, "
+            f"total submissions to fetch: {spec_args['batch_size'] * spec_args['laps']}, "
+            f"workers: {workers}"
+        )
+        # built by the first run with `refresh_after`, then kept up to date
+        index = None
+        if refresh_after is not None or SubmissionIndex.exists(
+            out_manager.subreddit_dir
+        ):
+            index = SubmissionIndex(out_manager.subreddit_dir)
+        pipeline = DownloadPipeline(
+            pushshift_clients.get(),
+            comment_workers,
+            out_manager,
+            spec_args["streaming"],
+            checkpoint_every,
+            index,
+            refresh_after,
+        )
+        downloads.append(
+            Download(
+                spec.subreddit,
+                spec_args["batch_size"],
+                spec_args["laps"],
+                direction,
+                checkpoint,
+                pipeline,
+            )
+        )
+
+    # Start the gathering, the writer stages of the subreddits run in parallel
+    try:
+        run_downloads(downloads)
+    finally:
+        comment_workers.close()
+    logger.info(f"Total Pushshift: {pushshift_clients.scheduler.total}")
+    logger.info(f"Total Reddit: {reddit_clients.scheduler.total}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,28 @@
+import pytest
+
+from tests.fakes import (
+    SUBMISSIONS_PER_SUBREDDIT,
+    SUBREDDITS,
+    FakePushshift,
+    FakeReddit,
+    FakeSubmission,
+)
+
+
+@pytest.fixture
+def submissions() -> list[FakeSubmission]:
+    return [
+        FakeSubmission(subreddit, index)
+        for subreddit in SUBREDDITS
+        for index in range(SUBMISSIONS_PER_SUBREDDIT)
+    ]
+
+
+@pytest.fixture
+def pushshift(submissions) -> FakePushshift:
+    return FakePushshift(submissions)
+
+
+@pytest.fixture
+def reddit(submissions) -> FakeReddit:
+    return FakeReddit(submissions)
@@ -0,0 +1,123 @@
+"""
+Fake Pushshift and Reddit clients, to run the download pipeline offline.
+They have only the methods and attributes the pipeline uses
+"""
+
+import threading
+from time import sleep
+
+from src.subreddit_downloader import RequestScheduler
+
+SUBREDDITS = ("test", "other")
+SUBMISSIONS_PER_SUBREDDIT = 20
+COMMENTS_PER_SUBMISSION = 3
+
+
+class FakeSubmission:
+    """A Pushshift search result, the raw fields are in `d_`"""
+
+    def __init__(self, subreddit: str, index: int):
+        self.subreddit = subreddit
+        self.id = f"{subreddit[0]}{index:04d}"
+        self.created_utc = 1600000000 + index * 60
+        self.title = f"Submission {index}"
+        self.full_link = f"https://www.reddit.com/r/{subreddit}/comments/{self.id}/"
+        self.d_ = dict(
+            author=f"author{index % 7}",
+            id=self.id,
+            created_utc=self.created_utc,
+            title=self.title,
+            permalink=f"/r/{subreddit}/comments/{self.id}/submission_{index}/",
+            score=index,
+            is_self=index % 2 == 0,
+            selftext=f"Text of {index}",
+            url=f"https://example.com/{index}",
+        )
+
+
+class FakeAuthor:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakeComment:
+    def __init__(self, submission: FakeSubmission, index: int):
+        self.id = f"{submission.id}c{index}"
+        self.body = f"Comment {index} of {submission.id}"
+        self.created_utc = submission.created_utc + index
+        self.parent_id = f"t3_{submission.id}"
+        self.permalink = f"{submission.d_['permalink']}{self.id}/"
+        self.score = index
+        # the deleted ones have no author
+        self.author = FakeAuthor(f"commenter{index}") if index else None
+
+
+class FakeCommentForest:
+    def __init__(self, comments: list):
+        self.comments = comments
+
+    def replace_more(self, limit=None):
+        pass
+
+    def list(self) -> list:
+        return list(self.comments)
+
+
+class FakeRedditSubmission:
+    def __init__(self, comments: list):
+        self.comments = FakeCommentForest(comments)
+
+
+class FakePushshift:
+    """
+    Search the submissions of the subreddits, newest first.
+    The searches are recorded in `searches`
+    """
+
+    def __init__(self, submissions: list[FakeSubmission]):
+        self.submissions = submissions
+        self.scheduler = RequestScheduler(requests_per_minute=10**6)
+        self.searches = []
+
+    def search_submissions(self, subreddit, limit, sort, sort_type, after, before):
+        assert (sort, sort_type) == ("desc", "created_utc")
+        self.searches.append((subreddit, after, before))
+        found = [
+            sub
+            for sub in self.submissions
+            if sub.subreddit == subreddit
+            and (after is None or sub.created_utc > after)
+            and (before is None or sub.created_utc < before)
+        ]
+        found.sort(key=lambda sub: sub.created_utc, reverse=True)
+        return iter(found[:limit])
+
+
+class FakeReddit:
+    """
+    The pool of Reddit clients, returning the comment trees of the submissions.
+    Fetching a submission takes `delays[id]` seconds, and the ones in
+    `failing` raise an error. The fetched ids are recorded in `fetched`
+    """
+
+    def __init__(self, submissions: list[FakeSubmission]):
+        self.comments = {
+            sub.id: [FakeComment(sub, i) for i in range(COMMENTS_PER_SUBMISSION)]
+            for sub in submissions
+        }
+        self.scheduler = RequestScheduler(requests_per_minute=10**6)
+        self.delays: dict[str, float] = {}
+        self.failing: set[str] = set()
+        self.fetched: list[str] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> "FakeReddit":
+        return self
+
+    def submission(self, id: str) -> FakeRedditSubmission:
+        sleep(self.delays.get(id, 0))
+        if id in self.failing:
+            raise RuntimeError(f"Failed to fetch {id}")
+        with self._lock:
+            self.fetched.append(id)
+        return FakeRedditSubmission(self.comments[id])
@@ -0,0 +1,44 @@
+import pyarrow.dataset as ds
+
+from src.export_parquet import main
+from src.jsonl import json_lines
+
+RETRIEVED_AT = 1700000000
+
+
+def comment(index: int, retrieved_at: int) -> dict:
+    return dict(
+        id=f"c{index:04d}",
+        author="commenter",
+        body=f"Comment {index}",
+        # two months
+        created_utc=1609459200 + index * 86400,
+        parent_id="t3_s0000",
+        permalink=f"/r/news/comments/s0000/x/c{index:04d}/",
+        score=retrieved_at - RETRIEVED_AT,
+        retrieved_at=retrieved_at,
+    )
+
+
+def test_duplicates_of_different_chunks_are_merged(tmp_path):
+    data_dir = tmp_path / "data"
+    # the second run retrieves again some comments of the first one
+    for run, retrieved_at, indexes in [
+        ("1", RETRIEVED_AT, range(0, 40)),
+        ("2", RETRIEVED_AT + 10, range(20, 60)),
+    ]:
+        path = data_dir / "news" / run / "comments" / "0.jsonl"
+        path.parent.mkdir(parents=True)
+        path.write_bytes(json_lines([comment(i, retrieved_at) for i in indexes]))
+    output_dir = tmp_path / "parquet"
+
+    main(data_dir=str(data_dir), output_dir=str(output_dir), chunk_size=10)
+
+    comments = ds.dataset(str(output_dir / "comment"), partitioning="hive")
+    rows = comments.to_table(columns=["id", "score", "month"]).to_pylist()
+    assert sorted((r["id"], r["score"]) for r in rows) == [
+        (f"c{i:04d}", 10 if i >= 20 else 0) for i in range(60)
+    ]
+    assert {r["month"] for r in rows} == {"2021-01", "2021-02", "2021-03"}
+    # a file per partition
+    assert len(comments.files) == 3
@@ -0,0 +1,131 @@
+import os
+import threading
+
+import pytest
+
+from src.ingest_backend import ParallelBackend, fetch_keys
+from src.ingest_schema import lookup_statement
+
+
+class FakeLookupDB:
+    """
+    A lookup table, the names in `concurrent` are being added by another
+    ingest and are found only from the second lookup
+    """
+
+    def __init__(self, concurrent: set):
+        self.table: dict[str, int] = {}
+        self.concurrent = concurrent
+        self.lookups = []
+
+    def lookup(self, table: str, names: list[str]) -> dict[str, int]:
+        self.lookups.append(names)
+        for name in names:
+            self.table.setdefault(name, len(self.table) + 1)
+        found = {name: self.table[name] for name in names}
+        if len(self.lookups) == 1:
+            for name in self.concurrent:
+                found.pop(name)
+        return found
+
+
+def test_fetch_keys_looks_up_the_new_names_in_order():
+    db = FakeLookupDB(concurrent={"b"})
+    keys = {"known": 100}
+
+    fetch_keys(db, "author", keys, {"d", "b", "known", "a"})
+
+    assert db.lookups == [["a", "b", "d"], ["b"]]
+    assert keys == {"known": 100, "a": 1, "b": 2, "d": 3}
+
+
+class FakeWriteDB:
+    """Records the ids written and committed, `hooks` run before some writes"""
+
+    def __init__(self, hooks: dict = None):
+        self.hooks = hooks or {}
+        self.writes = 0
+        self.written: list[str] = []
+        self.committed: list[str] = []
+
+    def upsert(self, submissions: dict, comments: dict):
+        self.writes += 1
+        if self.writes in self.hooks:
+            self.hooks[self.writes]()
+        self.written.extend(submissions)
+
+    def commit(self):
+        self.committed.extend(self.written)
+        self.written = []
+
+    def rollback(self):
+        self.written = []
+
+    def close(self):
+        pass
+
+
+def chunks(count: int) -> list[dict]:
+    return [{f"{i}-{n}": None for n in range(20)} for i in range(count)]
+
+
+def test_a_backend_writes_the_next_chunk_while_another_is_busy():
+    next_chunk = threading.Event()
+    waited = []
+    # the first part of the slow backend ends only when the fast one starts
+    # writing the next chunk
+    slow = FakeWriteDB({1: lambda: waited.append(next_chunk.wait(timeout=5))})
+    fast = FakeWriteDB({2: next_chunk.set})
+    db = ParallelBackend([slow, fast], chunks_in_flight=2)
+
+    for chunk in chunks(3):
+        db.upsert(chunk, {})
+    db.commit()
+    db.close()
+
+    assert waited == [True]
+    assert sorted(slow.committed + fast.committed) == sorted(
+        record_id for chunk in chunks(3) for record_id in chunk
+    )
+
+
+def test_the_error_of_a_chunk_in_flight_is_raised():
+    def fail():
+        raise RuntimeError("DB error")
+
+    failing, other = FakeWriteDB({1: fail}), FakeWriteDB()
+    db = ParallelBackend([failing, other], chunks_in_flight=2)
+
+    with pytest.raises(RuntimeError):
+        for chunk in chunks(3):
+            db.upsert(chunk, {})
+        db.commit()
+    db.rollback()
+    db.close()
+
+    assert (failing.committed, other.committed) == ([], [])
+    assert (failing.written, other.written) == ([], [])
+
+
+@pytest.mark.skipif(
+    "INGEST_TEST_CONNECTION_STRING" not in os.environ,
+    reason="needs a Postgres instance in INGEST_TEST_CONNECTION_STRING",
+)
+def test_lookup_statement_adds_the_names_in_order():
+    psycopg2 = pytest.importorskip("psycopg2")
+
+    with psycopg2.connect(os.environ["INGEST_TEST_CONNECTION_STRING"]) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMP TABLE lookup_test (id SERIAL, name TEXT UNIQUE)"
+            )
+            cursor.execute("INSERT INTO lookup_test (name) VALUES ('m')")
+            cursor.execute(
+                lookup_statement("lookup_test", "%(names)s::text[]"),
+                {"names": ["z", "m", "a"]},
+            )
+            keys = dict(cursor.fetchall())
+        assert keys.keys() == {"a", "m", "z"}
+        assert keys["m"] == 1
+        assert keys["a"] < keys["z"]
+        conn.rollback()
@@ -0,0 +1,204 @@
+import io
+import os
+import struct
+from typing import Optional
+
+import pytest
+
+from src.ingest_copy import (
+    COPY_HEADER,
+    PSQL_EPOCH,
+    comment_tuple,
+    compact_comment_tuple,
+    copy_buffers,
+    submission_tuple,
+)
+from src.ingest_helper import Comment, Submission
+from src.ingest_schema import COMMENT_TABLE, SUBMISSION_TABLE
+
+SUBMISSIONS = [
+    Submission(
+        author="author",
+        id="abc123",
+        created_utc=1600000000,
+        title="Naïve title ☃ 🎉",
+        retrieved_at=1700000000,
+        score=-5,
+        permalink="/r/test/comments/abc123/naive_title/",
+        locked=True,
+        selftext="",
+        link=None,
+        subreddit="test",
+    ),
+    Submission(
+        author="[deleted]",
+        id="abc124",
+        created_utc=1000000000,
+        title="",
+        retrieved_at=1700000001,
+        score=2**31 - 1,
+        permalink="/r/test/comments/abc124/x/",
+        locked=False,
+        selftext=None,
+        link="https://example.com/",
+        subreddit="test",
+    ),
+]
+COMMENTS = [
+    Comment(
+        id="def456",
+        author="commenter",
+        body="A comment\nwith two lines and a \\ and a \t",
+        created_utc=1600000100,
+        parent_id="t3_abc123",
+        permalink="/r/test/comments/abc123/naive_title/def456/",
+        score=0,
+        retrieved_at=1700000000,
+        subreddit="test",
+    )
+]
+
+
+def decode(data: bytes) -> list[list]:
+    """The fields of the tuples of binary COPY data, as bytes or None"""
+    assert data.startswith(COPY_HEADER)
+    offset = len(COPY_HEADER)
+    rows = []
+    while True:
+        (fields,) = struct.unpack_from(">h", data, offset)
+        offset += 2
+        if fields == -1:
+            break
+        row = []
+        for _ in range(fields):
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(data[offset : offset + length])
+            offset += length
+        rows.append(row)
+    assert offset == len(data)
+    return rows
+
+
+def text(field: Optional[bytes]) -> Optional[str]:
+    return None if field is None else field.decode()
+
+
+def timestamp(field: bytes) -> int:
+    (microseconds,) = struct.unpack(">q", field)
+    return microseconds // 1000000 + PSQL_EPOCH
+
+
+def integer(field: bytes) -> int:
+    return struct.unpack(">i" if len(field) == 4 else ">q", field)[0]
+
+
+def test_submission_tuples():
+    rows = decode(b"".join(copy_buffers(SUBMISSIONS, submission_tuple)))
+
+    assert [
+        [
+            text(row[0]),
+            text(row[1]),
+            text(row[2]),
+            timestamp(row[3]),
+            text(row[4]),
+            timestamp(row[5]),
+            integer(row[6]),
+            text(row[7]),
+            row[8] == b"\x01",
+            text(row[9]),
+            text(row[10]),
+        ]
+        for row in rows
+    ] == [
+        [
+            s.id,
+            s.subreddit,
+            s.author,
+            s.created_utc,
+            s.title,
+            s.retrieved_at,
+            s.score,
+            s.permalink,
+            s.locked,
+            s.selftext,
+            s.link,
+        ]
+        for s in SUBMISSIONS
+    ]
+
+
+def test_comment_tuples():
+    rows = decode(b"".join(copy_buffers(COMMENTS, comment_tuple)))
+
+    c = COMMENTS[0]
+    row = rows[0]
+    assert len(rows) == 1
+    assert [text(field) for field in row[:4]] == [c.id, c.subreddit, c.author, c.body]
+    assert timestamp(row[4]) == c.created_utc
+    assert [text(row[5]), text(row[6])] == [c.parent_id, c.permalink]
+    assert integer(row[7]) == c.score
+    assert timestamp(row[8]) == c.retrieved_at
+
+
+def test_compact_comment_tuples():
+    rows = decode(
+        b"".join(
+            copy_buffers(
+                COMMENTS,
+                lambda c: compact_comment_tuple(c, {"test": 3}, {"commenter": 7}),
+            )
+        )
+    )
+
+    assert [integer(field) for field in rows[0][:3]] == [int("def456", 36), 3, 7]
+    assert text(rows[0][6]) == "abc123/naive_title/def456/"
+
+
+def test_buffers_split_between_tuples():
+    records = SUBMISSIONS * 100
+    buffers = list(copy_buffers(records, submission_tuple, buffer_size=1000))
+
+    assert len(buffers) > 1
+    assert b"".join(buffers) == b"".join(copy_buffers(records, submission_tuple))
+    assert len(decode(b"".join(buffers))) == len(records)
+
+
+@pytest.mark.skipif(
+    "INGEST_TEST_CONNECTION_STRING" not in os.environ,
+    reason="needs a Postgres instance in INGEST_TEST_CONNECTION_STRING",
+)
+def test_postgres_reads_the_tuples():
+    psycopg2 = pytest.importorskip("psycopg2")
+
+    with psycopg2.connect(os.environ["INGEST_TEST_CONNECTION_STRING"]) as conn:
+        with conn.cursor() as cursor:
+            for table, columns, records, encode in (
+                ("submission", SUBMISSION_TABLE, SUBMISSIONS, submission_tuple),
+                ("comment", COMMENT_TABLE, COMMENTS, comment_tuple),
+            ):
+                cursor.execute(f"CREATE TEMP TABLE copy_{table} ({columns})")
+                cursor.copy_expert(
+                    f"COPY copy_{table} FROM STDIN WITH (FORMAT binary)",
+                    io.BytesIO(b"".join(copy_buffers(records, encode))),
+                )
+            cursor.execute(
+                "SELECT id, title, EXTRACT(EPOCH FROM created_utc)::bigint, score, "
+                "locked, selftext, link FROM copy_submission ORDER BY id"
+            )
+            assert cursor.fetchall() == [
+                (s.id, s.title, s.created_utc, s.score, s.locked, s.selftext, s.link)
+                for s in SUBMISSIONS
+            ]
+            cursor.execute(
+                "SELECT id, body, EXTRACT(EPOCH FROM retrieved_at)::bigint "
+                "FROM copy_comment"
+            )
+            assert cursor.fetchall() == [
+                (c.id, c.body, c.retrieved_at) for c in COMMENTS
+            ]
+        conn.rollback()
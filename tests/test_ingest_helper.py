@@ -0,0 +1,253 @@
+import gzip
+import json
+import multiprocessing
+from pathlib import Path
+import threading
+
+import pytest
+import zstandard
+
+from src.ingest_helper import IngestManifest, insertion_chunks
+from src.ingest_metrics import metrics
+from src.jsonl import json_lines
+
+RETRIEVED_AT = 1700000000
+
+
+def submission(subreddit: str, index: int, retrieved_at: int) -> dict:
+    record = dict(
+        author=f"author{index % 5}",
+        id=f"{subreddit[0]}{index:04d}",
+        created_utc=1600000000 + index,
+        title=f"Submission {index}",
+        permalink=f"/r/{subreddit}/comments/{subreddit[0]}{index:04d}/submission/",
+        score=retrieved_at - RETRIEVED_AT,
+        retrieved_at=retrieved_at,
+        locked=False,
+    )
+    if index % 2:
+        record["link"] = f"https://example.com/{index}"
+    else:
+        record["selftext"] = f"Text of {index}"
+    return record
+
+
+def comment(subreddit: str, index: int, retrieved_at: int) -> dict:
+    return dict(
+        id=f"{subreddit[0]}c{index:04d}",
+        author=f"commenter{index % 5}",
+        body=f"Comment {index} ☃",
+        created_utc=1600000000 + index,
+        parent_id=f"t3_{subreddit[0]}{index // 4:04d}",
+        permalink=f"/r/{subreddit}/comments/{subreddit[0]}{index // 4:04d}/x/",
+        score=retrieved_at - RETRIEVED_AT,
+        retrieved_at=retrieved_at,
+    )
+
+
+def write_jsonl(path: Path, records: list[dict]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = "".join(json.dumps(record) + "\n" for record in records).encode()
+    if path.name.endswith(".gz"):
+        data = gzip.compress(data)
+    elif path.name.endswith(".zst"):
+        data = zstandard.ZstdCompressor().compress(data)
+    path.write_bytes(data)
+
+
+@pytest.fixture
+def data_dir(tmp_path) -> Path:
+    """
+    Two subreddits downloaded by three runs, the later runs download again
+    some of the records, the last one before the second
+    """
+    data_dir = tmp_path / "data"
+    runs = [
+        # run, extension, retrieved_at, records
+        ("1", ".jsonl", RETRIEVED_AT, range(0, 40)),
+        ("2", ".jsonl.gz", RETRIEVED_AT + 20, range(20, 60)),
+        ("3", ".jsonl.zst", RETRIEVED_AT + 10, range(10, 50)),
+    ]
+    for subreddit in ("news", "askreddit"):
+        for run, extension, retrieved_at, indexes in runs:
+            run_dir = data_dir / subreddit / run
+            # a file per lap
+            for lap in range(2):
+                lap_indexes = indexes[lap::2]
+                write_jsonl(
+                    run_dir / "submissions" / f"{lap}{extension}",
+                    [submission(subreddit, i, retrieved_at) for i in lap_indexes],
+                )
+                write_jsonl(
+                    run_dir / "comments" / f"{lap}{extension}",
+                    [comment(subreddit, i, retrieved_at) for i in lap_indexes],
+                )
+    return data_dir
+
+
+def read_jsonl(path: Path) -> list[dict]:
+    data = path.read_bytes()
+    if path.name.endswith(".gz"):
+        data = gzip.decompress(data)
+    elif path.name.endswith(".zst"):
+        data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return [json.loads(line) for line in data.splitlines()]
+
+
+def latest_records(data_dir: Path) -> tuple[dict, dict]:
+    """The id and score of the last retrieved version of every record"""
+    latest = ({}, {})
+    for path in data_dir.glob("*/*/*/*"):
+        table = latest[path.parent.name == "comments"]
+        for record in read_jsonl(path):
+            if (
+                record["id"] not in table
+                or table[record["id"]]["retrieved_at"] < record["retrieved_at"]
+            ):
+                table[record["id"]] = record
+    return tuple(
+        {record_id: record["score"] for record_id, record in table.items()}
+        for table in latest
+    )
+
+
+def read_chunks(chunks) -> tuple[list, dict, dict]:
+    """The sizes of the chunks and their records merged, the last retrieved win"""
+    sizes, submissions, comments = [], {}, {}
+    for chunk_submissions, chunk_comments in chunks:
+        sizes.append(len(chunk_submissions) + len(chunk_comments))
+        for records, chunk_records in (
+            (submissions, chunk_submissions),
+            (comments, chunk_comments),
+        ):
+            for record_id, record in chunk_records.items():
+                if (
+                    record_id not in records
+                    or records[record_id].retrieved_at < record.retrieved_at
+                ):
+                    records[record_id] = record
+    return (
+        sizes,
+        {i: s.score for i, s in submissions.items()},
+        {i: c.score for i, c in comments.items()},
+    )
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_chunks_have_the_latest_records(data_dir, processes, prefetch):
+    sizes, submissions, comments = read_chunks(
+        insertion_chunks(data_dir=str(data_dir), processes=processes, prefetch=prefetch)
+    )
+
+    assert sizes == [len(submissions) + len(comments)]
+    assert (submissions, comments) == latest_records(data_dir)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_chunks_are_flushed_by_records(data_dir, processes):
+    chunk_size = 25
+    sizes, submissions, comments = read_chunks(
+        insertion_chunks(
+            chunk_size, data_dir=str(data_dir), processes=processes, prefetch=0
+        )
+    )
+
+    # flushed as soon as they have more than chunk_size records
+    assert len(sizes) > 1
+    assert max(sizes) <= chunk_size + 1
+    assert (submissions, comments) == latest_records(data_dir)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_chunks_are_flushed_by_bytes(data_dir, processes):
+    sizes, submissions, comments = read_chunks(
+        insertion_chunks(
+            data_dir=str(data_dir),
+            processes=processes,
+            prefetch=0,
+            submission_bytes=2000,
+            comment_bytes=2000,
+        )
+    )
+
+    assert len(sizes) > 1
+    assert (submissions, comments) == latest_records(data_dir)
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_stopping_early_ends_the_parsing(data_dir, processes):
+    chunks = insertion_chunks(5, str(data_dir), processes, prefetch=0)
+
+    next(chunks)
+    chunks.close()
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_a_failed_write_ends_the_prefetching(data_dir, processes):
+    threads = threading.active_count()
+
+    def ingest():
+        # with the default prefetch
+        for _ in insertion_chunks(5, str(data_dir), processes):
+            raise RuntimeError("DB error")
+
+    with pytest.raises(RuntimeError):
+        ingest()
+
+    # nothing is left parsing in the background, the process can exit
+    assert multiprocessing.active_children() == []
+    assert threading.active_count() == threads
+
+
+def test_parse_gauges_follow_the_parsing(data_dir):
+    depths = []
+    for _ in insertion_chunks(5, str(data_dir), 2, prefetch=0):
+        depths.append(
+            (
+                metrics.gauges["parse_queue_depth", ()],
+                metrics.gauges["parse_running_files", ()],
+            )
+        )
+
+    assert len(depths) > 1
+    # the queue holds at most a chunk per process, a few files per process run
+    assert all(queued <= 2 and running <= 4 for queued, running in depths)
+    assert (
+        metrics.gauges["parse_queue_depth", ()],
+        metrics.gauges["parse_running_files", ()],
+    ) == (0, 0)
+
+
+def test_manifest_skips_the_loaded_files(tmp_path, data_dir):
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = IngestManifest(manifest_path)
+    for _ in insertion_chunks(10, str(data_dir), 1, 0, manifest):
+        manifest.chunk_loaded()
+
+    manifest = IngestManifest(manifest_path)
+    _, submissions, comments = read_chunks(
+        insertion_chunks(10, str(data_dir), 1, 0, manifest)
+    )
+    assert (submissions, comments) == ({}, {})
+    assert manifest.skipped == len(list(data_dir.glob("*/*/*/*")))
+
+    # a file changed since is loaded again
+    changed = data_dir / "news" / "1" / "submissions" / "0.jsonl"
+    write_jsonl(changed, [submission("news", 100, RETRIEVED_AT)])
+    manifest = IngestManifest(manifest_path)
+    _, submissions, comments = read_chunks(
+        insertion_chunks(10, str(data_dir), 1, 0, manifest)
+    )
+    assert (submissions, comments) == ({"n0100": 0}, {})
+
+
+def test_lone_surrogates_are_replaced(tmp_path):
+    record = comment("news", 1, RETRIEVED_AT)
+    record["body"] = "Cut emoji \ud83d, whole one \U0001f600"
+    path = tmp_path / "news" / "1" / "comments" / "0.jsonl"
+    path.parent.mkdir(parents=True)
+    path.write_bytes(json_lines([record]))
+
+    [(_, comments)] = insertion_chunks(data_dir=str(tmp_path), processes=1)
+    assert comments[record["id"]].body == "Cut emoji \ufffd, whole one \U0001f600"
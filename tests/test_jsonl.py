@@ -0,0 +1,36 @@
+import gzip
+
+import pytest
+import zstandard
+
+from src.jsonl import json_lines, json_loads, open_jsonl
+
+
+def test_json_lines_keep_the_lone_surrogates():
+    records = [{"body": "Cut emoji \ud83d"}, {"body": "Whole one \U0001f600"}]
+
+    lines = json_lines(records).splitlines()
+
+    assert [json_loads(line) for line in lines] == records
+    assert [json_loads(line, replace_surrogates=True) for line in lines] == [
+        {"body": "Cut emoji \ufffd"},
+        {"body": "Whole one \U0001f600"},
+    ]
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz", ".jsonl.zst"])
+def test_open_jsonl_reads_the_utf8_lines(tmp_path, extension):
+    records = [{"body": "Snowman ☃"}, {"body": "Grinning \U0001f600"}]
+    data = json_lines(records)
+    if extension == ".jsonl.gz":
+        data = gzip.compress(data)
+    elif extension == ".jsonl.zst":
+        data = zstandard.ZstdCompressor().compress(data)
+    path = tmp_path / f"0{extension}"
+    path.write_bytes(data)
+
+    # bytes, whatever the locale encoding
+    with open_jsonl(path) as fr:
+        assert [json_loads(line) for line in fr] == records
+    with open_jsonl(str(path)) as fr:
+        assert all(isinstance(line, bytes) for line in fr)
@@ -0,0 +1,450 @@
+import gzip
+import io
+import os
+from os.path import join
+import threading
+
+import pytest
+import zstandard
+
+from src.subreddit_downloader import (
+    Checkpoint,
+    CommentWorkers,
+    Compression,
+    Download,
+    DownloadPipeline,
+    FairQueue,
+    LapWriter,
+    OutputManager,
+    RequestScheduler,
+    SubmissionIndex,
+    complete_size,
+    init_locals,
+    run_downloads,
+)
+from src.jsonl import json_loads, open_jsonl
+from tests.fakes import COMMENTS_PER_SUBMISSION, SUBREDDITS
+
+LAPS = 3
+BATCH_SIZE = 5
+
+
+def download(
+    output_dir,
+    pushshift,
+    reddit,
+    streaming: bool = False,
+    compression: Compression = Compression.none,
+    checkpoint: Checkpoint = None,
+    checkpoint_every: int = 100,
+    workers: int = 4,
+    index: SubmissionIndex = None,
+):
+    comment_workers = CommentWorkers(reddit, workers)
+    out_manager = OutputManager(str(output_dir), "test", "run", compression)
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+        out_manager.store_checkpoint(checkpoint)
+    pipeline = DownloadPipeline(
+        pushshift, comment_workers, out_manager, streaming, checkpoint_every, index
+    )
+    try:
+        return pipeline.run("test", BATCH_SIZE, LAPS, "before", checkpoint)
+    finally:
+        comment_workers.close()
+
+
+def read_lap(output_dir, kind: str, lap: int, compression=Compression.none):
+    path = join(output_dir, "test", "run", kind, f"{lap}{compression.extension}")
+    with open_jsonl(path) as fr:
+        return [json_loads(line) for line in fr]
+
+
+def read_all(output_dir, kind: str, compression=Compression.none):
+    return [
+        record
+        for lap in range(LAPS)
+        for record in read_lap(output_dir, kind, lap, compression)
+    ]
+
+
+def written_ids(output_dir, compression=Compression.none) -> set[str]:
+    """The submissions in the complete part of the lap files, after a crash"""
+    ids = set()
+    for lap in range(LAPS):
+        path = join(
+            output_dir, "test", "run", "submissions", f"{lap}{compression.extension}"
+        )
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read(complete_size(path, compression))
+        if compression == Compression.gzip:
+            data = gzip.decompress(data)
+        elif compression == Compression.zstd:
+            data = (
+                zstandard.ZstdDecompressor()
+                .stream_reader(io.BytesIO(data), read_across_frames=True)
+                .read()
+            )
+        ids.update(json_loads(line)["id"] for line in data.splitlines())
+    return ids
+
+
+def newest_ids(submissions, count: int = LAPS * BATCH_SIZE) -> list[str]:
+    test_submissions = [sub for sub in submissions if sub.subreddit == "test"]
+    test_submissions.sort(key=lambda sub: sub.created_utc, reverse=True)
+    return [sub.id for sub in test_submissions[:count]]
+
+
+def test_laps_keep_the_pushshift_order(tmp_path, submissions, pushshift, reddit):
+    expected_ids = newest_ids(submissions)
+    # the first submissions of every lap are the slowest to fetch
+    for position, submission_id in enumerate(expected_ids):
+        reddit.delays[submission_id] = 0.01 * (BATCH_SIZE - position % BATCH_SIZE)
+
+    download(tmp_path, pushshift, reddit)
+
+    for lap in range(LAPS):
+        lap_ids = expected_ids[lap * BATCH_SIZE : (lap + 1) * BATCH_SIZE]
+        assert [s["id"] for s in read_lap(tmp_path, "submissions", lap)] == lap_ids
+        comments = read_lap(tmp_path, "comments", lap)
+        assert [c["parent_id"] for c in comments] == [
+            f"t3_{i}" for i in lap_ids for _ in range(COMMENTS_PER_SUBMISSION)
+        ]
+
+
+def test_laps_continue_from_the_previous_one(tmp_path, submissions, pushshift, reddit):
+    expected_ids = newest_ids(submissions)
+
+    utc_after, utc_before = download(tmp_path, pushshift, reddit)
+
+    created = {sub.id: sub.created_utc for sub in submissions}
+    assert (utc_after, utc_before) == (
+        created[expected_ids[0]],
+        created[expected_ids[-1]],
+    )
+    # every lap continues before the oldest submission of the previous one
+    assert [before for _, _, before in pushshift.searches] == [
+        None,
+        created[expected_ids[BATCH_SIZE - 1]],
+        created[expected_ids[2 * BATCH_SIZE - 1]],
+    ]
+
+
+def test_submission_and_comment_fields(tmp_path, pushshift, reddit):
+    download(tmp_path, pushshift, reddit, workers=1)
+
+    submissions = read_lap(tmp_path, "submissions", 0)
+    assert submissions[0].keys() == {
+        "author",
+        "id",
+        "created_utc",
+        "title",
+        "permalink",
+        "score",
+        "retrieved_at",
+        "locked",
+        "selftext" if "selftext" in submissions[0] else "link",
+    }
+    comments = read_lap(tmp_path, "comments", 0)
+    assert {c["author"] for c in comments} == {"[deleted]", "commenter1", "commenter2"}
+
+
+@pytest.mark.parametrize("compression", list(Compression))
+def test_streaming_writes_every_submission(
+    tmp_path, submissions, pushshift, reddit, compression
+):
+    download(tmp_path, pushshift, reddit, streaming=True, compression=compression)
+
+    submission_ids = [s["id"] for s in read_all(tmp_path, "submissions", compression)]
+    assert sorted(submission_ids) == sorted(newest_ids(submissions))
+    comments = read_all(tmp_path, "comments", compression)
+    assert len(comments) == len(submission_ids) * COMMENTS_PER_SUBMISSION
+    checkpoint = OutputManager(str(tmp_path), "test", "run").load_checkpoint()
+    assert checkpoint.next_lap == LAPS
+    assert checkpoint.done_ids == []
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("compression", list(Compression))
+def test_resume_after_a_crash(
+    tmp_path, submissions, pushshift, reddit, streaming, compression
+):
+    expected_ids = newest_ids(submissions)
+    # crash in the middle of the last lap, after the others are stored and
+    # the rest of its submissions written
+    last_lap_ids = expected_ids[(LAPS - 1) * BATCH_SIZE :]
+    for submission_id in last_lap_ids:
+        reddit.delays[submission_id] = 0.05
+    reddit.failing.add(last_lap_ids[2])
+    reddit.delays[last_lap_ids[2]] = 0.2
+    with pytest.raises(RuntimeError):
+        download(
+            tmp_path,
+            pushshift,
+            reddit,
+            streaming=streaming,
+            compression=compression,
+        )
+
+    checkpoint = OutputManager(str(tmp_path), "test", "run").load_checkpoint()
+    checkpointed_ids = set(expected_ids[: checkpoint.next_lap * BATCH_SIZE])
+    checkpointed_ids.update(checkpoint.done_ids)
+    stored_ids = written_ids(tmp_path, compression)
+    assert checkpointed_ids <= stored_ids
+    if streaming and compression == Compression.none:
+        # written after the last checkpoint, the compressed files are flushed
+        # only at the checkpoints
+        assert stored_ids - checkpointed_ids
+    reddit.failing.clear()
+    reddit.fetched.clear()
+    download(
+        tmp_path,
+        pushshift,
+        reddit,
+        streaming=streaming,
+        compression=compression,
+        checkpoint=checkpoint,
+    )
+
+    # nothing stored before the crash is fetched again, nor duplicated
+    assert not stored_ids & set(reddit.fetched)
+    submission_ids = [s["id"] for s in read_all(tmp_path, "submissions", compression)]
+    assert sorted(submission_ids) == sorted(expected_ids)
+    comments = read_all(tmp_path, "comments", compression)
+    assert sorted(c["id"] for c in comments) == sorted(
+        f"{i}c{n}" for i in expected_ids for n in range(COMMENTS_PER_SUBMISSION)
+    )
+
+
+def test_a_failed_subreddit_stops_the_others(tmp_path, submissions, pushshift, reddit):
+    failing = max(
+        (sub for sub in submissions if sub.subreddit == "other"),
+        key=lambda sub: sub.created_utc,
+    ).id
+    reddit.failing.add(failing)
+    comment_workers = CommentWorkers(reddit, workers=2)
+    downloads = []
+    for subreddit in SUBREDDITS:
+        out_manager = OutputManager(str(tmp_path), subreddit, "run")
+        out_manager.store_params({})
+        pipeline = DownloadPipeline(pushshift, comment_workers, out_manager)
+        downloads.append(
+            Download(subreddit, BATCH_SIZE, LAPS, "before", Checkpoint(), pipeline)
+        )
+    errors = []
+
+    def download_all():
+        try:
+            run_downloads(downloads)
+        except RuntimeError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=download_all, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    comment_workers.close()
+
+    assert not thread.is_alive(), "the download hangs"
+    assert [str(e) for e in errors] == [f"Failed to fetch {failing}"]
+
+
+class CountingIndex(SubmissionIndex):
+    def __init__(self, subreddit_dir: str):
+        self.records = 0
+        super().__init__(subreddit_dir)
+        # not counting the rebuild
+        self.records = 0
+
+    def record(self, entries):
+        self.records += 1
+        super().record(entries)
+
+
+def test_streaming_indexes_at_every_checkpoint(
+    tmp_path, submissions, pushshift, reddit
+):
+    (tmp_path / "test").mkdir()
+    index = CountingIndex(str(tmp_path / "test"))
+
+    download(
+        tmp_path, pushshift, reddit, streaming=True, checkpoint_every=2, index=index
+    )
+
+    assert all(index.is_fresh(i, 60) for i in newest_ids(submissions))
+    # once every `checkpoint_every` submissions or lap end, not per submission
+    assert index.records <= LAPS * BATCH_SIZE // 2 + LAPS
+
+
+def test_rebuilt_index_counts_the_comments_of_the_latest_retrieval(tmp_path):
+    permalink = "/r/test/comments/a/title/{}/"
+    # the second run retrieves the submission again, with one more comment
+    for run_id, retrieved_at, comments in [("1", 1, 2), ("2", 2, 3)]:
+        out_manager = OutputManager(str(tmp_path), "test", run_id)
+        out_manager.append(
+            0,
+            {"id": "a", "retrieved_at": retrieved_at},
+            [
+                {"id": f"c{n}", "permalink": permalink.format(n)}
+                for n in range(comments)
+            ],
+        )
+        out_manager.close_lap(0)
+
+    index = SubmissionIndex(str(tmp_path / "test"))
+
+    rows = index._conn.execute("SELECT * FROM submission_index").fetchall()
+    assert rows == [("a", 2, 3)]
+
+
+def cli_args(**args) -> dict:
+    return {
+        "reddit_secret": "secret",
+        "subreddits": ["test"],
+        "subreddits_file": None,
+        "workers": 2,
+        "batch_size": 10,
+        "laps": 3,
+        "utc_after": None,
+        "utc_before": None,
+        "streaming": False,
+        "compression": Compression.none,
+        **args,
+    }
+
+
+def test_resume_keeps_the_run_parameters(tmp_path):
+    args = cli_args(
+        utc_after=1600000000, batch_size=7, streaming=True, compression="zstd"
+    )
+    direction, out_manager, _, _ = init_locals(
+        True, str(tmp_path), "test", 1600000000, None, False, Compression.zstd, args
+    )
+    assert direction == "after"
+
+    # resumed without repeating the arguments of the run
+    direction, resumed_manager, checkpoint, resumed_args = init_locals(
+        True, str(tmp_path), "test", None, None, True, Compression.none, cli_args()
+    )
+    assert direction == "after"
+    assert resumed_manager.runtime_dir == out_manager.runtime_dir
+    assert resumed_manager.compression == Compression.zstd
+    assert (resumed_args["batch_size"], resumed_args["streaming"]) == (7, True)
+    assert checkpoint == Checkpoint(utc_after=1600000000)
+
+
+@pytest.mark.parametrize("compression", list(Compression))
+def test_flushed_lap_files_are_readable(tmp_path, compression):
+    out_manager = OutputManager(str(tmp_path), "test", "run", compression)
+    out_manager.append(0, {"id": "a"}, [{"id": "ac"}])
+    out_manager.append(0, {"id": "b"}, [])
+    path = join(tmp_path, "test", "run", "submissions", f"0{compression.extension}")
+
+    # the compressed files end a frame or a member only at the checkpoints
+    if compression != Compression.none:
+        assert complete_size(path, compression) == 0
+        out_manager.flush()
+
+    # not closed, as after a crash
+    assert read_lap(tmp_path, "submissions", 0, compression) == [
+        {"id": "a"},
+        {"id": "b"},
+    ]
+    assert read_lap(tmp_path, "comments", 0, compression) == [{"id": "ac"}]
+
+
+@pytest.mark.parametrize("compression", list(Compression))
+def test_torn_tail_is_dropped_before_appending(tmp_path, compression):
+    out_manager = OutputManager(str(tmp_path), "test", "run", compression)
+    out_manager.append(0, {"id": "a"}, [])
+    out_manager.close_lap(0)
+    # a crash in the middle of writing the next submission
+    path = join(tmp_path, "test", "run", "submissions", f"0{compression.extension}")
+    torn = join(tmp_path, "torn")
+    writer = LapWriter(torn, join(tmp_path, "torn_comments"), compression)
+    writer.write([{"id": "b"}], [])
+    writer.close()
+    with open(torn, "rb") as fr, open(path, "ab") as fw:
+        data = fr.read()
+        fw.write(data[: len(data) // 2])
+
+    resumed_manager = OutputManager(str(tmp_path), "test", "run", compression)
+    resumed_manager.append(0, {"id": "c"}, [])
+    resumed_manager.close_lap(0)
+
+    assert read_lap(tmp_path, "submissions", 0, compression) == [
+        {"id": "a"},
+        {"id": "c"},
+    ]
+
+
+@pytest.mark.parametrize("compression", list(Compression))
+def test_recovered_lap_drops_the_comments_without_submission(tmp_path, compression):
+    out_manager = OutputManager(str(tmp_path), "test", "run", compression)
+    permalink = "/r/test/comments/{}/title/{}/"
+    out_manager.append(
+        0,
+        {"id": "a", "retrieved_at": 1},
+        [{"id": "ac", "permalink": permalink.format("a", "ac")}],
+    )
+    # a crash after the comments of the next submission are flushed
+    writer = out_manager.lap_writers[0]
+    writer.write([], [{"id": "bc", "permalink": permalink.format("b", "bc")}])
+    writer.flush()
+    writer.close()
+
+    resumed_manager = OutputManager(str(tmp_path), "test", "run", compression)
+    assert resumed_manager.recover_lap(0) == [("a", 1, 1)]
+    assert resumed_manager.recover_lap(1) == []
+    assert [c["id"] for c in read_lap(tmp_path, "comments", 0, compression)] == ["ac"]
+
+
+def test_complete_zstd_frames_are_kept_at_every_cut(tmp_path):
+    frames = [
+        zstandard.ZstdCompressor().compress(b'{"id": "a"}\n' * 100),
+        # a raw block, not compressible, and a checksum
+        zstandard.ZstdCompressor(write_checksum=True).compress(os.urandom(300)),
+        # a single RLE block, "a" repeated 100 times
+        b"\x28\xb5\x2f\xfd\x20\x64"
+        + (1 | 1 << 1 | 100 << 3).to_bytes(3, "little")
+        + b"a",
+    ]
+    assert zstandard.ZstdDecompressor().decompress(frames[2]) == b"a" * 100
+    data = b"".join(frames)
+    ends = [sum(len(frame) for frame in frames[:i]) for i in range(len(frames) + 1)]
+    path = tmp_path / f"0{Compression.zstd.extension}"
+
+    for cut in range(len(data) + 1):
+        path.write_bytes(data[:cut])
+        expected = max(end for end in ends if end <= cut)
+        assert complete_size(str(path), Compression.zstd) == expected
+
+
+def test_fair_queue_takes_turns():
+    queue = FairQueue(lane_size=10)
+    for item in ("a1", "a2", "a3"):
+        queue.put("a", item)
+    queue.put("b", "b1")
+    queue.close()
+
+    assert [queue.get() for _ in range(5)] == ["a1", "b1", "a2", "a3", None]
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.headers = {"retry-after": "0"} if status_code == 429 else {}
+
+
+def test_scheduler_retries_the_throttled_requests():
+    scheduler = RequestScheduler(requests_per_minute=10**6)
+    responses = iter([FakeResponse(429), FakeResponse(503), FakeResponse(200)])
+    scheduler.base_backoff = 0.001
+
+    with scheduler.tagged("tag"):
+        response = scheduler.request(lambda: next(responses))
+
+    assert response.status_code == 200
+    stats = scheduler.pop_stats("tag")
+    assert (stats.requests, stats.retries) == (3, 2)